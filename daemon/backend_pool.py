@@ -0,0 +1,242 @@
+from twisted.internet import reactor
+
+import time
+import logging
+from functools import partial
+
+import config
+import metrics
+
+# Smoothing factor for latency and error rate averages.
+EWMA_ALPHA = 0.2
+# Error rate above which a backend is taken out of rotation.
+EJECT_ERROR_RATE = 0.5
+# Replies needed before the error rate is trusted.
+EJECT_MIN_SAMPLES = 10
+# Seconds an ejected backend stays out before being tried again.
+EJECT_TIME = 30
+
+# Seconds without a reply before a request counts as failed.
+BACKEND_TIMEOUT = 30
+
+# Commands taking the reply callback as a positional argument.
+POSITIONAL_CALLBACKS = {
+    "fetch_history": 1,
+    "fetch_stealth": 1
+}
+
+# Calls that must stay on the backend holding the address subscription.
+PINNED_CALLS = set([
+    "subscribe_address",
+    "renew_address",
+    "unsubscribe_address"
+])
+
+# Errors that are a valid answer, not a sign of an unhealthy backend.
+BENIGN_ERRORS = set(["not_found"])
+
+class Backend(object):
+
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+        self.ejected_until = 0
+
+    @property
+    def available(self):
+        return self.ejected_until <= time.time()
+
+    def score(self):
+        # Lower is better. Unknown latency counts as fast so new and
+        # re-admitted backends get probed.
+        latency = self.latency or 0.001
+        return latency * (1 + self.inflight) * (1 + 10 * self.error_rate)
+
+    def record(self, latency, failed):
+        self.inflight -= 1
+        self.samples += 1
+        if failed:
+            self.errors += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.error_rate += EWMA_ALPHA * (float(failed) - self.error_rate)
+        if self.samples >= EJECT_MIN_SAMPLES and \
+                self.error_rate > EJECT_ERROR_RATE:
+            self.eject()
+
+    def eject(self):
+        logging.warning("Ejecting obelisk backend %s, error rate %.2f",
+                        self.url, self.error_rate)
+        self.ejections += 1
+        self.ejected_until = time.time() + \
+            config.get("backend-eject-time", EJECT_TIME)
+        # Start from a clean slate once re-admitted.
+        self.error_rate = 0.0
+        self.samples = 0
+        self.latency = None
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'inflight': self.inflight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'ejections': self.ejections,
+            'available': self.available
+        }
+
+class BackendPool(object):
+    """Stands in for ObeliskOfLightClient and routes every call to the
+    healthiest, least loaded of several obelisk servers.
+
+    Address subscriptions stay on the backend they were made on. When it
+    is ejected they are made again on another one, and move listeners are
+    told which addresses moved since updates may have been lost.
+    """
+
+    def __init__(self, backends):
+        self._backends = backends
+        self._timeout = config.get("backend-timeout", BACKEND_TIMEOUT)
+        metrics.registry.register(self.collect_metrics)
+        # address -> (Backend holding its subscription, update callback)
+        self._pinned = {}
+        self._move_listeners = []
+        self.moved = 0
+
+    def add_move_listener(self, listener):
+        # listener(addresses) after their subscriptions moved backend.
+        self._move_listeners.append(listener)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return partial(self._call, name)
+
+    def select(self):
+        available = [backend for backend in self._backends
+                     if backend.available]
+        if not available:
+            # Everything is ejected, better to try than to fail outright.
+            available = self._backends
+        return min(available, key=lambda backend: backend.score())
+
+    def _pinned_backend(self, method_name, args):
+        address = args[0]
+        pinned = self._pinned.get(address)
+        if pinned is None:
+            backend = self.select()
+            if method_name == "subscribe_address":
+                self._pinned[address] = (backend, args[1])
+            return backend
+        if method_name == "unsubscribe_address":
+            del self._pinned[address]
+        return pinned[0]
+
+    def _move_subscriptions(self, backend):
+        addresses = [address for address, pinned in self._pinned.items()
+                     if pinned[0] is backend]
+        target = self.select()
+        if not addresses or target is backend:
+            return
+        logging.warning("Moving %d subscriptions from %s to %s",
+                        len(addresses), backend.url, target.url)
+        for address in addresses:
+            callback = self._pinned[address][1]
+            self._pinned[address] = (target, callback)
+            try:
+                backend.client.unsubscribe_address(address, callback,
+                                                   cb=None)
+            except:
+                logging.error("Error unsubscribing %s from %s", address,
+                              backend.url, exc_info=True)
+            target.client.subscribe_address(
+                address, callback,
+                cb=self._wrap(target, partial(self._on_moved, address)))
+        self.moved += len(addresses)
+        for listener in self._move_listeners:
+            try:
+                listener(addresses)
+            except:
+                logging.error("Error in move listener", exc_info=True)
+
+    def _on_moved(self, address, error, *args):
+        if error:
+            logging.error("Error moving subscription of %s: %s",
+                          address, error)
+
+    def _record(self, backend, latency, failed):
+        ejections = backend.ejections
+        backend.record(latency, failed)
+        if backend.ejections != ejections:
+            self._move_subscriptions(backend)
+
+    def _call(self, method_name, *args, **kwargs):
+        if method_name in PINNED_CALLS:
+            backend = self._pinned_backend(method_name, args)
+        else:
+            backend = self.select()
+        if "cb" in kwargs and kwargs["cb"] is not None:
+            kwargs["cb"] = self._wrap(backend, kwargs["cb"])
+        elif method_name in POSITIONAL_CALLBACKS:
+            index = POSITIONAL_CALLBACKS[method_name]
+            args = list(args)
+            args[index] = self._wrap(backend, args[index])
+        method = getattr(backend.client, method_name)
+        return method(*args, **kwargs)
+
+    def _wrap(self, backend, cb):
+        start = time.time()
+        backend.inflight += 1
+        backend.requests += 1
+        def on_timeout():
+            # No reply in time counts as a failure, a late reply is still
+            # passed on but not recorded again.
+            timeout[0] = None
+            self._record(backend, time.time() - start, True)
+        timeout = [reactor.callLater(self._timeout, on_timeout)]
+        def wrapped_cb(error, *args):
+            if timeout[0] is not None:
+                timeout[0].cancel()
+                timeout[0] = None
+                failed = error is not None and error not in BENIGN_ERRORS
+                self._record(backend, time.time() - start, failed)
+            return cb(error, *args)
+        return wrapped_cb
+
+    def stats(self):
+        return [backend.stats() for backend in self._backends]
+
+    def collect_metrics(self):
+        Metric = metrics.Metric
+        latency = Metric("gateway_backend_latency_seconds", "gauge",
+                         "EWMA latency per obelisk backend")
+        error_rate = Metric("gateway_backend_error_rate", "gauge",
+                            "EWMA error rate per obelisk backend")
+        inflight = Metric("gateway_backend_inflight", "gauge",
+                          "Requests pending per obelisk backend")
+        requests = Metric("gateway_backend_requests_total", "counter",
+                          "Requests sent per obelisk backend")
+        ejections = Metric("gateway_backend_ejections_total", "counter",
+                           "Times each obelisk backend was ejected")
+        for backend in self._backends:
+            latency.add(backend.latency, backend=backend.url)
+            error_rate.add(backend.error_rate, backend=backend.url)
+            inflight.add(backend.inflight, backend=backend.url)
+            requests.add(backend.requests, backend=backend.url)
+            ejections.add(backend.ejections, backend=backend.url)
+        moved = Metric("gateway_backend_moved_subscriptions_total",
+                       "counter",
+                       "Address subscriptions moved off ejected backends")
+        moved.add(self.moved)
+        return [latency, error_rate, inflight, requests, ejections, moved]
@@ -0,0 +1,168 @@
+from twisted.internet import reactor
+
+import logging
+import threading
+from functools import partial
+
+import config
+
+MAX_BATCH_SIZE = 100
+# Seconds before sub-requests still unanswered get a timeout, longer than
+# any backend deadline so it only catches handlers that never reply.
+BATCH_TIMEOUT = 150
+
+# Commands answering with exactly one response and keeping no state on the
+# socket, so they can safely run on behalf of a batch.
+BATCH_COMMANDS = set([
+    "fetch_last_height",
+    "fetch_transaction",
+    "fetch_history",
+    "fetch_block_header",
+    "fetch_block_transaction_hashes",
+    "fetch_spend",
+    "fetch_transaction_index",
+    "fetch_block_height",
+    "fetch_stealth2",
+    "fetch_ticker",
+    "chan_list",
+    "chan_get"
+])
+
+def is_paginated(request):
+    # fetch_history with a page size answers with several frames.
+    params = request["params"]
+    return request["command"] == "fetch_history" and len(params) > 2 and \
+        bool(params[2])
+
+class BatchCollector(object):
+    """Stands in for the socket handler of every sub-request in a batch.
+
+    Sub-requests are dispatched with their position in the batch as id, so
+    clients may reuse ids inside a batch. Responses are either streamed to
+    the socket as they arrive or gathered into a single frame. Once the
+    deadline passes every sub-request still waiting is answered with a
+    timeout, so one stuck handler can't hold up the whole batch.
+    """
+
+    def __init__(self, handler, request_id, request_ids, stream):
+        self._handler = handler
+        self._request_id = request_id
+        self._request_ids = request_ids
+        self._stream = stream
+        self._results = [None] * len(request_ids)
+        self._remaining = len(request_ids)
+        self._lock = threading.Lock()
+        self._deadline = None
+
+    @property
+    def _connected(self):
+        # Queued sub-requests are dropped once the socket is gone.
+        return getattr(self._handler, "_connected", True)
+
+    def set_deadline(self, timeout):
+        self._deadline = reactor.callLater(timeout, self._expire)
+
+    def _expire(self):
+        self._deadline = None
+        for index, result in enumerate(self._results):
+            if result is None:
+                self.reject(index, "timeout")
+
+    def queue_response(self, response):
+        index = response.get("id")
+        with self._lock:
+            if type(index) != int or not 0 <= index < len(self._results) \
+                    or self._results[index] is not None:
+                logging.warning("Unexpected batch response: %s", index)
+                return
+            response = dict(response, id=self._request_ids[index])
+            self._results[index] = response
+            self._remaining -= 1
+            finished = self._remaining == 0
+        if self._stream:
+            self._handler.queue_response(response)
+        if finished:
+            self.finish()
+
+    def reject(self, index, error):
+        self.queue_response({"id": index, "error": error, "result": None})
+
+    def finish(self):
+        if self._deadline is not None:
+            if self._deadline.active():
+                self._deadline.cancel()
+            self._deadline = None
+        if self._stream:
+            result = [len(self._results)]
+        else:
+            result = self._results
+        self._handler.queue_response({
+            "id": self._request_id,
+            "error": None,
+            "result": result
+        })
+
+class BatchHandler:
+
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+        self._max_size = config.get("batch-max-size", MAX_BATCH_SIZE)
+        self._timeout = config.get("batch-timeout", BATCH_TIMEOUT)
+
+    def register(self, commands):
+        commands.register("batch", self.handle_request,
+                          cost=partial(self._cost, commands))
+
+    def _cost(self, commands, params):
+        # A batch weighs as much as its sub-requests.
+        if not params or type(params[0]) != list:
+            return 1
+        return 1 + sum(commands.cost(sub_request)
+                       for sub_request in params[0]
+                       if type(sub_request) == dict)
+
+    def _error(self, socket_handler, request, error):
+        socket_handler.queue_response({
+            "id": request["id"],
+            "error": error,
+            "result": None
+        })
+
+    def handle_request(self, socket_handler, request):
+        if request["command"] != "batch":
+            return False
+        params = request["params"]
+        if len(params) not in (1, 2) or type(params[0]) != list:
+            self._error(socket_handler, request, "Invalid batch")
+            return True
+        sub_requests = params[0]
+        stream = len(params) == 2 and params[1] == "stream"
+        if not sub_requests:
+            self._error(socket_handler, request, "Empty batch")
+            return True
+        if len(sub_requests) > self._max_size:
+            self._error(socket_handler, request,
+                        "Batch too big, maximum is %d" % self._max_size)
+            return True
+        request_ids = [sub_request.get("id") if type(sub_request) == dict
+                       else None for sub_request in sub_requests]
+        collector = BatchCollector(socket_handler, request["id"],
+                                   request_ids, stream)
+        collector.set_deadline(self._timeout)
+        # All sub-requests are sent upstream right away and answer in
+        # whatever order the backend replies.
+        for index, sub_request in enumerate(sub_requests):
+            if type(sub_request) != dict or \
+                    not socket_handler._check_request(sub_request):
+                collector.reject(index, "Malformed request")
+                continue
+            if sub_request["command"] not in BATCH_COMMANDS:
+                collector.reject(index, "Command not allowed in batch")
+                continue
+            if is_paginated(sub_request):
+                collector.reject(index, "Pagination not allowed in batch")
+                continue
+            sub_request = dict(sub_request, id=index)
+            if not self._dispatch(collector, sub_request):
+                collector.reject(index, "Unhandled command")
+        return True
@@ -1,26 +1,34 @@
 import time
+import logging
 import obelisk
 import zmq
 import radar
 import config
 import struct
+import metrics
 from collections import defaultdict
 from twisted.internet import reactor
 from broadcast_connector import BroadcastConnector
+from bus import LeaderRelay
 
 def hash_transaction(raw_tx):
     return obelisk.Hash(raw_tx)[::-1]
 
 class Broadcaster:
 
-    def __init__(self):
+    def __init__(self, bus=None):
         self.connector = BroadcastConnector()
         self.last_status = time.time()
         self.last_nodes = 0
         self.issues = 0
         self.notifications = defaultdict(list)
-        reactor.callInThread(self.status_loop)
-        reactor.callInThread(self.feedback_loop)
+        self.broadcasts = 0
+        self.failures = 0
+        relay = LeaderRelay(bus)
+        self._relay_feedback = relay.topic("brc_feedback",
+                                           self.on_feedback_msg, binary=True)
+        self._relay_status = relay.topic("brc_status", self.on_status)
+        relay.run(self.status_loop, self.feedback_loop)
         reactor.callLater(1, self.watchdog)
 
     def watchdog(self):
@@ -44,10 +52,16 @@ class Broadcaster:
                 msg.append(socket.recv())
                 print "feedback msg"
             if len(msg) == 3:
-                self.on_feedback_msg(*msg)
+                self._relay_feedback(*msg)
             else:
                 print "bad feedback message", len(msg)
 
+    def on_status(self, nodes):
+        self.last_status = time.time()
+        if not nodes == self.last_nodes:
+            print "brc hosts", nodes
+            self.last_nodes = nodes
+
     def on_feedback_msg(self, hash, num, error):
         try:
             num = struct.unpack("<Q", num)[0]
@@ -73,21 +87,23 @@ class Broadcaster:
         print "brc status channel connected"
         while True:
             msg = socket.recv()
-            nodes = 0
             try:
                 nodes = struct.unpack("<Q", msg)[0]
-                self.last_status = time.time()
             except:
                 print "bad nodes data", msg
-            if not nodes == self.last_nodes:
-                print "brc hosts", nodes
-                self.last_nodes = nodes
+                continue
+            self._relay_status(nodes)
 
-    def broadcast(self, raw_tx, notify):
+    def broadcast(self, raw_tx, notify, timer=None):
         tx_hash = hash_transaction(raw_tx)
         self.notifications[tx_hash].append(notify)
+        self.broadcasts += 1
         def cb(txhash, error, result):
+            if timer:
+                timer.backend_done()
+                timer.finish(error or not result)
             if error or not result:
+                self.failures += 1
                 notify(0, 'brc', 'Broadcaster could not propagate')
             else:
                 notify(result, 'brc')
@@ -110,23 +126,68 @@ class NotifyCallback:
 
 class BroadcastHandler:
 
-    def __init__(self):
-        self._brc = Broadcaster()
-        self._radar = radar.Radar()
+    def __init__(self, bus=None):
+        self._brc = Broadcaster(bus)
+        self._radar = radar.Radar(bus)
+        metrics.registry.register(self.collect_metrics)
+
+    def register(self, commands):
+        commands.register("broadcast_transaction", self.handle_request,
+                          cost=5)
+
+    def stats(self):
+        return {
+            'brc': {'peers': self._brc.last_nodes,
+                    'issues': self._brc.issues},
+            'radar': {'peers': self._radar.radar_hosts,
+                      'issues': self._radar.issues}
+        }
+
+    def collect_metrics(self):
+        Metric = metrics.Metric
+        return [
+            Metric("gateway_broadcasts_total", "counter",
+                   "Transactions handed to the broadcaster")
+                .add(self._brc.broadcasts),
+            Metric("gateway_broadcast_failures_total", "counter",
+                   "Broadcasts the broadcaster could not propagate")
+                .add(self._brc.failures),
+            Metric("gateway_broadcaster_peers", "gauge",
+                   "Nodes connected to the broadcaster")
+                .add(self._brc.last_nodes),
+            Metric("gateway_broadcaster_issues", "gauge",
+                   "Seconds without broadcaster status")
+                .add(self._brc.issues),
+            Metric("gateway_radar_peers", "gauge",
+                   "Nodes connected to the radar")
+                .add(self._radar.radar_hosts),
+            Metric("gateway_radar_issues", "gauge",
+                   "Seconds without radar status")
+                .add(self._radar.issues)
+        ]
 
     def handle_request(self, socket_handler, request):
         if request["command"] != "broadcast_transaction":
             return False
-        if not request["params"]:
-            logging.error("No param for broadcast specified.")
+        timer = metrics.commands.start("broadcast_transaction")
+        try:
+            raw_tx = request["params"][0].decode("hex")
+        except (IndexError, TypeError, AttributeError):
+            logging.error("No valid param for broadcast specified.")
+            socket_handler.queue_response({
+                "id": request["id"],
+                "error": "Bad parameters specified",
+                "result": None
+            })
+            timer.finish("Bad parameters specified")
             return True
-        raw_tx = request["params"][0].decode("hex")
         request_id = request["id"]
         # Prepare notifier object
         notify = NotifyCallback(socket_handler, request_id)
         # Broadcast...
         print "BROADCAT"
-        self._brc.broadcast(raw_tx, notify)
+        # Timed until the broadcaster answers, radar progress comes later.
+        self._brc.broadcast(raw_tx, notify, timer)
         # And monitor.
         print "BROADCAST"
         tx_hash = hash_transaction(raw_tx)
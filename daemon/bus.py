@@ -0,0 +1,229 @@
+import time
+import json
+import zlib
+import logging
+import threading
+from collections import defaultdict
+
+import zmq
+from twisted.internet import reactor
+
+import config
+
+# Seconds between heartbeats, a node missing a few is considered gone.
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_MISSES = 3
+# Key whose owner runs the gateway wide singletons.
+LEADER_KEY = "leader"
+
+class Bus(object):
+    """Publish/subscribe link between gateway workers or cluster nodes.
+
+    Every message published reaches every other node, a node never gets
+    its own messages back. Messages are [topic, sender, JSON args]
+    frames, so binary values must be hex encoded by the publisher.
+    Handlers are called on the reactor thread as handler(sender, *args).
+
+    Keys such as addresses are spread over the live nodes by owner(), the
+    node owning a key is the one doing the upstream work for it. Nodes
+    send heartbeats, and membership listeners are told whenever a node
+    goes away or comes back so owned work can move.
+
+    The owner of LEADER_KEY is the leader, running what only one node
+    should: the p2p node, the broadcaster and radar feeds, chain polling
+    and the ticker. When it stops sending heartbeats another node takes
+    over.
+    """
+
+    def __init__(self, node, nodes, publish_url, subscribe_urls, bind=False):
+        self.node = node
+        self.nodes = nodes
+        self._sender = str(node)
+        self._context = zmq.Context()
+        self._publisher = self._context.socket(zmq.PUB)
+        if bind:
+            self._publisher.bind(publish_url)
+        else:
+            self._publisher.connect(publish_url)
+        # Publishing may happen from the ZMQ listener threads too.
+        self._lock = threading.Lock()
+        self._handlers = defaultdict(list)
+        self._membership_listeners = []
+        self._leader_listeners = []
+        self._heartbeat_interval = config.get("bus-heartbeat-interval",
+                                              HEARTBEAT_INTERVAL)
+        # node -> time last heard from, everyone is assumed up at first.
+        now = time.time()
+        self._last_seen = dict((other, now) for other in xrange(nodes))
+        self._live = range(nodes)
+        self._leading = self.is_leader()
+        self.published = 0
+        self.received = 0
+        reactor.callInThread(self._listen, subscribe_urls)
+        reactor.callLater(self._heartbeat_interval, self._heartbeat)
+
+    def owner(self, key):
+        # Rendezvous hashing, only keys of a node that leaves or joins
+        # change owner.
+        return max(self._live, key=lambda node:
+                   zlib.crc32("%d:%s" % (node, key)) & 0xffffffff)
+
+    def is_owner(self, key):
+        return self.owner(key) == self.node
+
+    def is_leader(self):
+        return self.is_owner(LEADER_KEY)
+
+    def add_leader_listener(self, listener):
+        # listener() is called every time this node becomes the leader,
+        # right away if it already is.
+        self._leader_listeners.append(listener)
+        if self._leading:
+            listener()
+
+    def subscribe(self, topic, handler):
+        self._handlers[topic].append(handler)
+
+    def add_membership_listener(self, listener):
+        # listener(live_nodes)
+        self._membership_listeners.append(listener)
+
+    def publish(self, topic, *args):
+        message = [topic, self._sender, json.dumps(args)]
+        with self._lock:
+            self._publisher.send_multipart(message)
+            self.published += 1
+
+    def _heartbeat(self):
+        self.publish("heartbeat")
+        now = time.time()
+        self._last_seen[self.node] = now
+        expired = now - HEARTBEAT_MISSES * self._heartbeat_interval
+        self._update_live([node for node, seen in
+                           sorted(self._last_seen.items()) if seen > expired])
+        reactor.callLater(self._heartbeat_interval, self._heartbeat)
+
+    def _update_live(self, live):
+        if live == self._live:
+            return
+        logging.warning("Bus nodes up: %s", live)
+        self._live = live
+        for listener in self._membership_listeners:
+            try:
+                listener(live)
+            except:
+                logging.error("Error in membership listener", exc_info=True)
+        leading = self.is_leader()
+        if leading == self._leading:
+            return
+        self._leading = leading
+        if not leading:
+            logging.warning("Node %d no longer the leader", self.node)
+            return
+        logging.warning("Node %d is now the leader", self.node)
+        for listener in self._leader_listeners:
+            try:
+                listener()
+            except:
+                logging.error("Error in leader listener", exc_info=True)
+
+    def _listen(self, subscribe_urls):
+        socket = self._context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, "")
+        for url in subscribe_urls:
+            socket.connect(url)
+        while True:
+            message = socket.recv_multipart()
+            if len(message) != 3:
+                logging.warning("Bad bus message, %d frames", len(message))
+                continue
+            topic, sender, args = message
+            if sender == self._sender:
+                continue
+            reactor.callFromThread(self._dispatch, topic, int(sender), args)
+
+    def _dispatch(self, topic, sender, args):
+        self.received += 1
+        if sender not in self._last_seen:
+            logging.warning("Bus message from unknown node %s", sender)
+            return
+        self._last_seen[sender] = time.time()
+        if sender not in self._live:
+            self._update_live(sorted(self._live + [sender]))
+        try:
+            args = json.loads(args)
+        except ValueError:
+            logging.warning("Bad bus message on %s", topic)
+            return
+        for handler in self._handlers[topic]:
+            try:
+                handler(sender, *args)
+            except:
+                logging.error("Error handling bus message on %s", topic,
+                              exc_info=True)
+
+    def stats(self):
+        return {
+            'node': self.node,
+            'nodes': self.nodes,
+            'live': self._live,
+            'leader': self.owner(LEADER_KEY),
+            'published': self.published,
+            'received': self.received
+        }
+
+class LeaderRelay(object):
+    """Feeds only the leader listens to, with what it hears relayed to
+    the other nodes over the bus.
+
+    Without a bus this node is the only one and always leads. The feed
+    loops are started in threads the first time this node leads and keep
+    their connection after that, but what they hear is dropped while
+    another node leads.
+    """
+
+    def __init__(self, bus=None):
+        self._bus = bus
+        self._loops = None
+
+    def leading(self):
+        return self._bus is None or self._bus.is_leader()
+
+    def topic(self, topic, handler, binary=False):
+        """Returns a function for the feed loops to pass what they hear
+        to, which calls handler on every node. Arguments of binary topics
+        are raw bytes and get hex encoded for the bus."""
+        def relay(*args):
+            if not self.leading():
+                return
+            if self._bus is not None:
+                if binary:
+                    self._bus.publish(topic,
+                                      *[arg.encode("hex") for arg in args])
+                else:
+                    self._bus.publish(topic, *args)
+            handler(*args)
+        def on_bus(node, *args):
+            if self.leading():
+                # Heard from the feed already.
+                return
+            if binary:
+                args = [arg.decode("hex") for arg in args]
+            handler(*args)
+        if self._bus is not None:
+            self._bus.subscribe(topic, on_bus)
+        return relay
+
+    def run(self, *loops):
+        self._loops = loops
+        if self._bus is None:
+            self._start()
+        else:
+            self._bus.add_leader_listener(self._start)
+
+    def _start(self):
+        if self._loops is None:
+            return
+        loops, self._loops = self._loops, None
+        for loop in loops:
+            reactor.callInThread(loop)
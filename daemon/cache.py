@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+import config
+from encoding import JSON
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+def estimate_size(value):
+    # Size of the value as it will end up on the wire.
+    return len(JSON.dumps(value))
+
+class LRUCache(object):
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used.
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        # Lookup without touching recency or hit counts.
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+def create_cache(name, default_size=DEFAULT_CACHE_SIZE):
+    return LRUCache(config.get(name, default_size))
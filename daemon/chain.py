@@ -0,0 +1,250 @@
+import struct
+import logging
+import obelisk
+import zmq
+from twisted.internet import reactor
+
+import config
+from encoding import Binary
+
+HEADER_RING_SIZE = 1000
+POLL_INTERVAL = 10
+
+def header_hash(header):
+    return obelisk.Hash(header)[::-1].encode("hex")
+
+def header_prev_hash(header):
+    return header[4:36][::-1].encode("hex")
+
+class ChainTracker(object):
+    """Follows the chain tip and keeps the last headers indexed by height
+    and by hash.
+
+    New blocks come from the obelisk block publisher when block-url is
+    configured, and from polling the backend otherwise. With a bus only
+    the leader does either, and relays every header it adds (the tip once
+    per poll too) to the others.
+    """
+
+    def __init__(self, client, bus=None):
+        self._client = client
+        self._bus = bus
+        self._size = config.get("header-ring-size", HEADER_RING_SIZE)
+        self.height = None
+        # height -> (hex hash, Binary header)
+        self._headers = {}
+        # hash -> height
+        self._heights = {}
+        self._block_listeners = []
+        self._reorg_listeners = []
+        self.reorgs = 0
+        self._poll_interval = config.get("chain-poll-interval", POLL_INTERVAL)
+        self._started = False
+        # Whether a fork is being walked back.
+        self._resyncing = False
+        if bus is None:
+            self._start()
+            return
+        bus.subscribe("chain_block", self.on_bus_block)
+        bus.add_leader_listener(self._start)
+
+    def _start(self):
+        # Polling and the publisher keep going once started, they are
+        # only listened to while leading.
+        if self._started:
+            return
+        self._started = True
+        self.poll()
+        if config.get("block-url"):
+            reactor.callInThread(self.block_loop)
+
+    def _leading(self):
+        return self._bus is None or self._bus.is_leader()
+
+    def add_block_listener(self, callback):
+        # callback(height, block_hash, header)
+        self._block_listeners.append(callback)
+
+    def add_reorg_listener(self, callback):
+        # callback(fork_height), every block above fork_height changed.
+        self._reorg_listeners.append(callback)
+
+    def header_by_height(self, height):
+        entry = self._headers.get(height)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def header_by_hash(self, block_hash):
+        height = self._heights.get(block_hash)
+        if height is None:
+            return None
+        return self._headers[height][1]
+
+    def height_by_hash(self, block_hash):
+        return self._heights.get(block_hash)
+
+    # Polling the backend
+
+    def poll(self):
+        if self._leading():
+            self._client.fetch_last_height(cb=self._on_last_height)
+        reactor.callLater(self._poll_interval, self.poll)
+
+    def _on_last_height(self, error, height=None):
+        if error:
+            logging.error("Error fetching last height: %s", error)
+            return
+        if self.height is not None and height > self.height:
+            # Fetch whatever we are missing, at most a ring full.
+            start = max(self.height + 1, height - self._size + 1)
+        else:
+            # Refetching the tip spots a reorg to a chain of the same height.
+            start = height
+        for missing in xrange(start, height + 1):
+            self._client.fetch_block_header(
+                missing, cb=lambda error, header=None, missing=missing:
+                    self._on_header(error, missing, header))
+
+    def _on_header(self, error, height, header):
+        if error:
+            logging.error("Error fetching header %s: %s", height, error)
+            return
+        self._add_own_block(height, header)
+
+    # Block publisher
+
+    def block_loop(self, *args):
+        ctx = zmq.Context()
+        socket = ctx.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, "")
+        socket.connect(config.get("block-url"))
+        print "block publisher connected"
+        while True:
+            msg = [socket.recv()]
+            while socket.getsockopt(zmq.RCVMORE):
+                msg.append(socket.recv())
+            # height, header, tx hashes...
+            if len(msg) < 2 or len(msg[0]) != 4 or len(msg[1]) != 80:
+                print "bad block message", len(msg)
+                continue
+            height = struct.unpack("<I", msg[0])[0]
+            reactor.callFromThread(self._add_own_block, height, msg[1])
+
+    # Relaying over the bus
+
+    def _add_own_block(self, height, header):
+        if not self._leading():
+            return
+        self.add_block(height, header, relay=True)
+
+    def on_bus_block(self, node, height, header):
+        self.add_block(height, header.decode("hex"))
+
+    # Index maintenance
+
+    def add_block(self, height, header, relay=False):
+        block_hash = header_hash(header)
+        current = self._headers.get(height)
+        if current is not None and current[0] == block_hash:
+            if relay and self._bus is not None:
+                # Lets the others catch up on a tip they missed.
+                self._bus.publish("chain_block", height, header.encode("hex"))
+            return
+        previous = self._headers.get(height - 1)
+        if previous is not None and previous[0] != header_prev_hash(header):
+            # Our parent was orphaned too, the fork may go deeper.
+            self._find_fork(height, header, relay)
+            return
+        if current is not None:
+            # A different block at a height we already know.
+            self._reorganize(height - 1)
+        self._insert(height, block_hash, header, relay)
+
+    def _insert(self, height, block_hash, header, relay):
+        if relay and self._bus is not None:
+            self._bus.publish("chain_block", height, header.encode("hex"))
+        self._headers[height] = (block_hash, Binary(header))
+        self._heights[block_hash] = height
+        if self.height is None or height > self.height:
+            self.height = height
+        self._prune()
+        for callback in self._block_listeners:
+            try:
+                callback(height, block_hash, header)
+            except:
+                logging.error("Error in block listener", exc_info=True)
+
+    def _find_fork(self, height, header, relay):
+        """Walks back from a header that doesn't link to ours, fetching
+        its ancestors until one matches the header we hold at the same
+        height. Everything above that is dropped and the fetched branch
+        added in its place."""
+        if self._resyncing:
+            # The tip gets refetched on the next poll.
+            return
+        self._resyncing = True
+        self._fetch_ancestor([(height, header)], relay)
+
+    def _fetch_ancestor(self, branch, relay):
+        height = branch[0][0] - 1
+        lowest = min(self._headers) if self._headers else height
+        if height < lowest or branch[-1][0] - height > self._size:
+            # Forked below everything we hold.
+            self._switch_branch(height, branch, relay)
+            return
+        self._client.fetch_block_header(
+            height, cb=lambda error, header=None:
+                self._on_ancestor(error, branch, relay, header))
+
+    def _on_ancestor(self, error, branch, relay, header):
+        height = branch[0][0] - 1
+        if error:
+            logging.error("Error fetching header %s: %s", height, error)
+            self._resyncing = False
+            return
+        if header_hash(header) != header_prev_hash(branch[0][1]):
+            # The backend moved on meanwhile, start over on the next poll.
+            self._resyncing = False
+            return
+        current = self._headers.get(height)
+        if current is not None and current[0] == header_hash(header):
+            self._switch_branch(height, branch, relay)
+            return
+        branch.insert(0, (height, header))
+        self._fetch_ancestor(branch, relay)
+
+    def _switch_branch(self, fork_height, branch, relay):
+        self._resyncing = False
+        self._reorganize(fork_height)
+        for height, header in branch:
+            self._insert(height, header_hash(header), header, relay)
+
+    def _reorganize(self, fork_height):
+        logging.warning("Chain reorganization above height %d", fork_height)
+        self.reorgs += 1
+        for height in [height for height in self._headers
+                       if height > fork_height]:
+            block_hash = self._headers.pop(height)[0]
+            self._heights.pop(block_hash, None)
+        if self.height is not None and self.height > fork_height:
+            self.height = fork_height
+        for callback in self._reorg_listeners:
+            try:
+                callback(fork_height)
+            except:
+                logging.error("Error in reorg listener", exc_info=True)
+
+    def _prune(self):
+        lowest = self.height - self._size
+        for height in [height for height in self._headers
+                       if height <= lowest]:
+            block_hash = self._headers.pop(height)[0]
+            self._heights.pop(block_hash, None)
+
+    def stats(self):
+        return {
+            'height': self.height,
+            'headers': len(self._headers),
+            'reorgs': self.reorgs
+        }
@@ -0,0 +1,24 @@
+import config
+from bus import Bus
+
+def cluster_bus():
+    """Bus linking the gateway nodes listed in the cluster config.
+
+    Every node binds its own endpoint and listens to all the others:
+
+        "cluster": {
+            "node": 0,
+            "nodes": ["tcp://10.0.0.1:8890", "tcp://10.0.0.2:8890"]
+        }
+
+    Returns None when not clustered.
+    """
+    settings = config.get("cluster")
+    if not settings:
+        return None
+    node = settings["node"]
+    urls = settings["nodes"]
+    if not 0 <= node < len(urls):
+        raise ValueError("cluster node %d not in nodes list" % node)
+    peers = [url for index, url in enumerate(urls) if index != node]
+    return Bus(node, len(urls), urls[node], peers, bind=True)
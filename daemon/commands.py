@@ -0,0 +1,148 @@
+from twisted.internet import reactor
+
+import logging
+
+import config
+import metrics
+
+# Seconds a request may hold a concurrency slot without being answered,
+# longer than any backend deadline.
+SLOT_TIMEOUT = 150
+
+class Command(object):
+    """A websocket command and what is known about serving it."""
+
+    def __init__(self, name, handler, cost=1, concurrency=None,
+                 cacheable=False):
+        self.name = name
+        # handler(socket_handler, request)
+        self.handler = handler
+        # Relative weight of a request, 1 for a cheap lookup. Either a
+        # number or a function of the request params.
+        self.cost = cost
+        # Most requests served at once gateway wide, None for no limit.
+        self.concurrency = concurrency
+        self.cacheable = cacheable
+        # Requests holding a concurrency slot.
+        self.active = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def request_cost(self, params):
+        if not callable(self.cost):
+            return self.cost
+        try:
+            return self.cost(params)
+        except Exception:
+            # Malformed params, they get rejected further down anyway.
+            return 1
+
+    def stats(self):
+        return {
+            'cost': self.cost if not callable(self.cost) else None,
+            'concurrency': self.concurrency,
+            'cacheable': self.cacheable,
+            'active': self.active,
+            'rejected': self.rejected,
+            'expired': self.expired
+        }
+
+class CommandRegistry(object):
+    """Maps every command straight to the handler serving it.
+
+    Handlers register their commands at startup. disconnect_client is
+    not owned by anyone, every handler keeping per socket state adds a
+    disconnect listener instead.
+    """
+
+    def __init__(self):
+        self._commands = {}
+        self._disconnect_listeners = []
+        self._costs = config.get("command-costs", {})
+        self._concurrency = config.get("command-concurrency", {})
+        self._slot_timeout = config.get("command-slot-timeout", SLOT_TIMEOUT)
+        self.register("disconnect_client", self._on_disconnect_client)
+
+    def register(self, name, handler, cost=1, concurrency=None,
+                 cacheable=False):
+        if name in self._commands:
+            raise ValueError("Command %s already registered" % name)
+        self._commands[name] = Command(
+            name, handler, self._costs.get(name, cost),
+            self._concurrency.get(name, concurrency), cacheable)
+
+    def add_disconnect_listener(self, listener):
+        self._disconnect_listeners.append(listener)
+
+    def get(self, name):
+        return self._commands.get(name)
+
+    def cost(self, request):
+        command = self._commands.get(request.get("command"))
+        if command is None:
+            return 1
+        params = request.get("params")
+        if type(params) != list:
+            params = []
+        return command.request_cost(params)
+
+    def dispatch(self, socket_handler, request):
+        command = self._commands.get(request["command"])
+        if command is None:
+            return False
+        if command.concurrency is None:
+            command.handler(socket_handler, request)
+            return True
+        if command.active >= command.concurrency:
+            command.rejected += 1
+            socket_handler.queue_response({
+                "id": request["id"],
+                "error": "Too many concurrent requests",
+                "result": None
+            })
+            return True
+        release = self._acquire(command)
+        # The slot is given back once the request timer finishes, right
+        # away if the handler starts none or fails.
+        claim = None
+        try:
+            with metrics.commands.claim_next(command.name, release) as claim:
+                command.handler(socket_handler, request)
+        finally:
+            if claim is None or not claim.taken:
+                release()
+        return True
+
+    def _acquire(self, command):
+        def on_timeout():
+            # Never answered, don't hold the slot forever.
+            timeout[0] = None
+            command.expired += 1
+            release()
+        def release():
+            if released[0]:
+                return
+            released[0] = True
+            if timeout[0] is not None:
+                if timeout[0].active():
+                    timeout[0].cancel()
+                timeout[0] = None
+            command.active -= 1
+        command.active += 1
+        released = [False]
+        timeout = [reactor.callLater(self._slot_timeout, on_timeout)]
+        return release
+
+    def disconnect(self, socket_handler):
+        for listener in self._disconnect_listeners:
+            try:
+                listener(socket_handler)
+            except:
+                logging.error("Error disconnecting client", exc_info=True)
+
+    def _on_disconnect_client(self, socket_handler, request):
+        self.disconnect(socket_handler)
+
+    def stats(self):
+        return dict((name, command.stats())
+                    for name, command in self._commands.iteritems())
@@ -0,0 +1,133 @@
+import time
+import logging
+from contextlib import contextmanager
+
+import config
+
+COMPRESSION_LEVEL = 6
+COMPRESSION_MEM_LEVEL = 8
+COMPRESSION_MIN_SIZE = 256
+
+# Deflate context kept between the frames of a connection ("connection"),
+# or started afresh for every frame so nothing is held between them
+# ("message").
+COMPRESSION_CONTEXTS = ("connection", "message")
+
+def compression_options():
+    """Options for tornado's permessage-deflate, None if disabled."""
+    if not config.get("websocket-compression", True):
+        return None
+    return {
+        "compression_level": config.get("websocket-compression-level",
+                                        COMPRESSION_LEVEL),
+        "mem_level": config.get("websocket-compression-mem-level",
+                                COMPRESSION_MEM_LEVEL)
+    }
+
+class CompressionStats(object):
+
+    def __init__(self):
+        self.frames = 0
+        # Frames sent uncompressed for being under the minimum size.
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def ratio(self):
+        if not self.compressed_bytes:
+            return None
+        return float(self.raw_bytes) / self.compressed_bytes
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'raw_bytes': self.raw_bytes,
+            'compressed_bytes': self.compressed_bytes,
+            'ratio': self.ratio,
+            'seconds': self.seconds
+        }
+
+# Totals over every connection, past and present.
+totals = CompressionStats()
+
+class MeasuredCompressor(object):
+    """Wraps the compressor of a websocket connection.
+
+    Counts bytes and time spent compressing, per connection and in the
+    totals, and drops the deflate context after every frame when the
+    configured context is "message".
+
+    This leans on tornado internals: the connection keeps its compressor
+    in _compressor, and the compressor its zlib object in _compressor.
+    Both are checked before use, and anything else tornado asks of the
+    compressor goes straight to the wrapped one.
+    """
+
+    def __init__(self, compressor, context, min_size):
+        self._compressor = compressor
+        self._per_message = context == "message"
+        if self._per_message and not hasattr(compressor, "_compressor"):
+            logging.warning("Per message compression context not "
+                            "supported by this tornado, keeping the "
+                            "connection context")
+            self._per_message = False
+        self.min_size = min_size
+        self.stats = CompressionStats()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._compressor, name)
+
+    def compress(self, data):
+        if self._per_message:
+            # Without a persistent zlib object tornado creates one per
+            # frame. Peers must cope with a reset window, RFC 7692 lets
+            # the server stop using context takeover at any time.
+            self._compressor._compressor = None
+        start = time.time()
+        compressed = self._compressor.compress(data)
+        elapsed = time.time() - start
+        for stats in (self.stats, totals):
+            stats.frames += 1
+            stats.raw_bytes += len(data)
+            stats.compressed_bytes += len(compressed)
+            stats.seconds += elapsed
+        return compressed
+
+    @contextmanager
+    def skip(self, connection):
+        """Frames written inside the block go out uncompressed."""
+        if getattr(connection, "_compressor", None) is not self:
+            # Not installed on this connection, leave it alone.
+            yield
+            return
+        self.stats.skipped += 1
+        totals.skipped += 1
+        connection._compressor = None
+        try:
+            yield
+        finally:
+            connection._compressor = self
+
+def install(connection):
+    """Wraps the compressor negotiated on a tornado websocket connection.
+
+    Returns the MeasuredCompressor or None if the client did not agree
+    to permessage-deflate, or tornado keeps its compressor elsewhere and
+    the stock one is left in place.
+    """
+    compressor = getattr(connection, "_compressor", None)
+    if compressor is None or not hasattr(compressor, "compress"):
+        return None
+    context = config.get("websocket-compression-context", "connection")
+    if context not in COMPRESSION_CONTEXTS:
+        context = "connection"
+    min_size = config.get("websocket-compression-min-size",
+                          COMPRESSION_MIN_SIZE)
+    connection._compressor = MeasuredCompressor(compressor, context,
+                                                min_size)
+    return connection._compressor
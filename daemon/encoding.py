@@ -0,0 +1,137 @@
+import json
+import time
+from functools import total_ordering
+
+msgpack_enabled = False
+try:
+    import msgpack
+    msgpack_enabled = True
+except ImportError:
+    pass
+
+cbor_enabled = False
+try:
+    import cbor
+    cbor_enabled = True
+except ImportError:
+    pass
+
+@total_ordering
+class Binary(object):
+    """Raw bytes of a hash or transaction in a response.
+
+    They stay raw until the response is encoded: JSON sends them hex
+    encoded, binary encodings as they are. The hex form is worked out
+    once, for the first JSON client.
+    """
+    __slots__ = ("data", "_hex")
+
+    def __init__(self, data):
+        self.data = data
+        self._hex = None
+
+    @property
+    def hex(self):
+        if self._hex is None:
+            self._hex = self.data.encode("hex")
+        return self._hex
+
+    def __eq__(self, other):
+        return isinstance(other, Binary) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.data < other.data
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __repr__(self):
+        return "Binary(%r)" % self.hex
+
+def json_default(value):
+    if isinstance(value, Binary):
+        return value.hex
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def to_binary(value):
+    # Prepare a response for a binary encoding: hashes and transactions
+    # are sent raw, every other string is text.
+    if isinstance(value, Binary):
+        return value.data
+    if isinstance(value, str):
+        return value.decode("utf8")
+    if isinstance(value, dict):
+        return dict((to_binary(key), to_binary(item))
+                    for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [to_binary(item) for item in value]
+    return value
+
+class JsonEncoding(object):
+    name = "json"
+    binary = False
+
+    def dumps(self, response):
+        return json.dumps(response, default=json_default)
+
+    def loads(self, message):
+        return json.loads(message)
+
+class MsgpackEncoding(object):
+    name = "msgpack"
+    binary = True
+
+    def dumps(self, response):
+        return msgpack.packb(to_binary(response), use_bin_type=True)
+
+    def loads(self, message):
+        return msgpack.unpackb(message, raw=False)
+
+class CborEncoding(object):
+    name = "cbor"
+    binary = True
+
+    def dumps(self, response):
+        return cbor.dumps(to_binary(response))
+
+    def loads(self, message):
+        return cbor.loads(message)
+
+class PreEncoded(object):
+    """A response pushed to many sockets.
+
+    It is serialized only once per encoding and the same frame is written
+    to every recipient. The response must not be changed once shared.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self._frames = {}
+
+    def frame(self, encoding, observe=None):
+        message = self._frames.get(encoding.name)
+        if message is None:
+            start = time.time()
+            message = encoding.dumps(self.response)
+            if observe is not None:
+                observe(time.time() - start)
+            self._frames[encoding.name] = message
+        return message
+
+    def keys(self):
+        return self.response.keys()
+
+JSON = JsonEncoding()
+
+# Binary encodings clients can ask for, depending on what is installed.
+encodings = {}
+if msgpack_enabled:
+    encodings["msgpack"] = MsgpackEncoding()
+if cbor_enabled:
+    encodings["cbor"] = CborEncoding()
+
+def get_encoding(name):
+    return encodings.get(name, JSON)
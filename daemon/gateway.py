@@ -4,12 +4,15 @@ import logging
 import tornado.options
 import tornado.web
 import tornado.websocket
+import tornado.httpserver
+import tornado.netutil
 import os.path
 import obelisk
 import json
 import threading
 import traceback
 import code
+import time
 ws_legacy_enabled = False
 try:
     from ws_client import LegacyClient
@@ -45,6 +48,16 @@ import jsonchan
 import broadcast
 import ticker
 import status
+import batch
+import backend_pool
+import metrics
+import encoding
+import compression
+import outbox
+import commands
+import ratelimit
+import workers
+import cluster
 
 define("port", default=8888, help="run on the given port", type=int)
 
@@ -53,7 +66,7 @@ ioloop = tornado.ioloop.IOLoop.instance()
 
 class GatewayApplication(tornado.web.Application):
 
-    def __init__(self, service):
+    def __init__(self, service, bus=None):
         settings = dict(debug=True)
         settings.update(options.as_dict())
         # legacy support
@@ -63,13 +76,42 @@ class GatewayApplication(tornado.web.Application):
             else:
                 print "legacy-url is configured but autobahn not installed"
                 self.ws_client = False
-        client = obelisk.ObeliskOfLightClient(service)
-        self.obelisk_handler = obelisk_handler.ObeliskHandler(client, self.ws_client)
-        self.brc_handler = broadcast.BroadcastHandler()
-        self.p2p = CryptoTransportLayer(config.get('p2p-port', 8889), config.get('external-ip', '127.0.0.1'), config.get('internal-ip', None))
-        self.p2p.join_network(config.get('seeds', []))
-        self.json_chan_handler = jsonchan.JsonChanHandler(self.p2p)
-        self.ticker_handler = ticker.TickerHandler()
+        # obelisk-url can list several backends to balance between.
+        if isinstance(service, list):
+            self.backend_pool = backend_pool.BackendPool([
+                backend_pool.Backend(url, obelisk.ObeliskOfLightClient(url))
+                for url in service])
+            client = self.backend_pool
+        else:
+            self.backend_pool = None
+            client = obelisk.ObeliskOfLightClient(service)
+        # Set when running as one of several worker processes.
+        self.bus = bus
+        self.obelisk_handler = obelisk_handler.ObeliskHandler(client, self.ws_client, bus)
+        if self.backend_pool is not None:
+            self.backend_pool.add_move_listener(
+                self.obelisk_handler.subscriptions.on_backend_moved)
+        self.brc_handler = broadcast.BroadcastHandler(bus)
+        # Only the leading worker or cluster node joins the p2p network.
+        self.p2p = None
+        self.json_chan_handler = jsonchan.JsonChanHandler(bus)
+        if bus is None:
+            self.start_p2p()
+        else:
+            bus.add_leader_listener(self.start_p2p)
+        self.ticker_handler = ticker.TickerHandler(bus)
+        self.batch_handler = batch.BatchHandler(self.dispatch_request)
+        self.commands = commands.CommandRegistry()
+        for handler in (self.json_chan_handler, self.obelisk_handler,
+                        self.brc_handler, self.ticker_handler,
+                        self.batch_handler):
+            handler.register(self.commands)
+        # Workers each see a share of the clients of an address.
+        shares = 1
+        if bus is not None and workers.worker_index() is not None:
+            shares = bus.nodes
+        self.rate_limiter = ratelimit.RateLimiter(shares)
+        metrics.registry.register(self.collect_metrics)
 
         handlers = [
             # /block/<block hash>
@@ -91,15 +133,116 @@ class GatewayApplication(tornado.web.Application):
             # /height
             (r"/height(?:/)?", rest_handlers.HeightHandler),
 
-            # /height
-            (r"/status(?:/)?", status.StatusHandler, {"app": self}),
-
             # /
             (r"/", QuerySocketHandler)
         ]
+        status_handlers = [
+            # /status
+            (r"/status(?:/)?", status.StatusHandler, {"app": self}),
+
+            # /metrics
+            (r"/metrics(?:/)?", status.MetricsHandler)
+        ]
+        # Workers share the websocket port, where a scrape could land on
+        # any of them, so each serves its own numbers on a port of its own.
+        self.status_application = None
+        if workers.worker_index() is None:
+            handlers = status_handlers + handlers
+        else:
+            self.status_application = tornado.web.Application(
+                status_handlers)
 
         tornado.web.Application.__init__(self, handlers, **settings)
 
+    def start_p2p(self):
+        # Stays on the network once joined, leadership only decides
+        # whether it relays.
+        if self.p2p is not None:
+            return
+        self.p2p = CryptoTransportLayer(config.get('p2p-port', 8889), config.get('external-ip', '127.0.0.1'), config.get('internal-ip', None))
+        self.p2p.join_network(config.get('seeds', []))
+        self.json_chan_handler.set_p2p(self.p2p)
+
+    def collect_metrics(self):
+        Metric = metrics.Metric
+        with QuerySocketHandler.listen_lock:
+            listeners = list(QuerySocketHandler.listeners)
+        ticker = self.ticker_handler.stats()
+        collected = [
+            Metric("gateway_connections", "gauge",
+                   "Open websocket connections")
+                .add(len(listeners)),
+            Metric("gateway_ticker_issues", "gauge",
+                   "Whether the ticker failed its last update")
+                .add(ticker['issues']),
+            Metric("gateway_compression_frames_total", "counter",
+                   "Websocket frames sent, by whether they were compressed")
+                .add(compression.totals.frames, compressed="true")
+                .add(compression.totals.skipped, compressed="false"),
+            Metric("gateway_compression_raw_bytes_total", "counter",
+                   "Websocket payload bytes before compression")
+                .add(compression.totals.raw_bytes),
+            Metric("gateway_compression_compressed_bytes_total", "counter",
+                   "Websocket payload bytes after compression")
+                .add(compression.totals.compressed_bytes),
+            Metric("gateway_compression_seconds_total", "counter",
+                   "Time spent compressing websocket frames")
+                .add(compression.totals.seconds),
+            Metric("gateway_buffered_bytes", "gauge",
+                   "Bytes written to websockets but not yet flushed")
+                .add(sum(listener._outbox.buffered_bytes
+                         for listener in listeners)),
+            Metric("gateway_queued_responses", "gauge",
+                   "Responses waiting in websocket outboxes")
+                .add(sum(listener._outbox.queued
+                         for listener in listeners)),
+            Metric("gateway_dropped_notifications_total", "counter",
+                   "Notifications dropped for slow clients")
+                .add(outbox.totals.dropped),
+            Metric("gateway_paused_clients_total", "counter",
+                   "Times notifications to a slow client were paused")
+                .add(outbox.totals.pauses),
+            Metric("gateway_slow_client_disconnects_total", "counter",
+                   "Slow clients disconnected for overflowing their outbox")
+                .add(outbox.totals.disconnects)
+        ]
+        if self.p2p is not None:
+            collected.extend([
+                Metric("gateway_p2p_peers", "gauge", "Known p2p peers")
+                    .add(self.p2p.peer_count),
+                Metric("gateway_p2p_messages_sent_total", "counter",
+                       "Messages sent to p2p peers")
+                    .add(self.p2p.messages_sent),
+                Metric("gateway_p2p_bytes_sent_total", "counter",
+                       "Bytes sent to p2p peers")
+                    .add(self.p2p.bytes_sent),
+                Metric("gateway_p2p_messages_received_total", "counter",
+                       "Messages received from p2p peers")
+                    .add(self.p2p.messages_received),
+                Metric("gateway_p2p_bytes_received_total", "counter",
+                       "Bytes received from p2p peers")
+                    .add(self.p2p.bytes_received)
+            ])
+        return collected
+
+    def connection_stats(self):
+        with QuerySocketHandler.listen_lock:
+            listeners = list(QuerySocketHandler.listeners)
+        return [listener.stats() for listener in listeners]
+
+    def admit_request(self, request, address, connection=None):
+        command = request["command"]
+        if not isinstance(command, basestring) or \
+                self.commands.get(command) is None:
+            # Keeps made up command names out of the counters.
+            command = "unknown"
+        return self.rate_limiter.admit(command,
+                                       self.commands.cost(request),
+                                       address, connection)
+
+    def dispatch_request(self, socket_handler, request):
+        return self.commands.dispatch(socket_handler, request)
+
 class QuerySocketHandler(tornado.websocket.WebSocketHandler):
 
     # Set of WebsocketHandler
@@ -114,8 +257,27 @@ class QuerySocketHandler(tornado.websocket.WebSocketHandler):
         self._ticker_handler = self.application.ticker_handler
         self._subscriptions = defaultdict(dict)
         self._connected = False
+        self._encoding = encoding.JSON
+        self._compressor = None
+        self._outbox = outbox.Outbox(ioloop, self._send_response, self.close)
+
+    def get_compression_options(self):
+        return compression.compression_options()
+
+    def select_subprotocol(self, subprotocols):
+        # Binary clients ask for "msgpack" or "cbor", everyone else
+        # gets JSON text frames.
+        for name in subprotocols:
+            if name in encoding.encodings:
+                self._encoding = encoding.encodings[name]
+                return name
+        return None
 
     def open(self):
+        if self._encoding is encoding.JSON:
+            name = self.get_argument("encoding", None)
+            self._encoding = encoding.get_encoding(name)
+        self._compressor = compression.install(self.ws_connection)
         logging.info("OPEN")
         with QuerySocketHandler.listen_lock:
             self.listeners.add(self)
@@ -123,10 +285,9 @@ class QuerySocketHandler(tornado.websocket.WebSocketHandler):
 
     def on_close(self):
         logging.info("CLOSE")
-        disconnect_msg = {'command': 'disconnect_client', 'id': 0, 'params': []}
         self._connected = False
-        self._obelisk_handler.handle_request(self, disconnect_msg)
-        self._json_chan_handler.handle_request(self, disconnect_msg)
+        self._outbox.close()
+        self.application.commands.disconnect(self)
         with QuerySocketHandler.listen_lock:
             self.listeners.remove(self)
 
@@ -136,45 +297,86 @@ class QuerySocketHandler(tornado.websocket.WebSocketHandler):
 
     def on_message(self, message):
         try:
-            request = json.loads(message)
+            # Text frames are always JSON, binary ones use the negotiated
+            # encoding.
+            if isinstance(message, unicode):
+                request = json.loads(message)
+            else:
+                request = self._encoding.loads(message)
         except:
-            logging.error("Error decoding message: %s", message, exc_info=True)
+            logging.error("Error decoding message: %r", message, exc_info=True)
+            return
 
         # Check request is correctly formed.
         if not self._check_request(request):
             logging.error("Malformed request: %s", request, exc_info=True)
             return
-        # Try different handlers until one accepts request and
-        # processes it.
-        if self._json_chan_handler.handle_request(self, request):
-            return
-        if self._obelisk_handler.handle_request(self, request):
-            return
-        if self._brc_handler.handle_request(self, request):
+        if not self.application.admit_request(request, self.request.remote_ip,
+                                              self):
+            self.queue_response({
+                "id": request["id"],
+                "error": "Rate limit exceeded",
+                "result": None
+            })
             return
-        if self._ticker_handler.handle_request(self, request):
+        if self.application.dispatch_request(self, request):
             return
         logging.warning("Unhandled command. Dropping request: %s",
             request, exc_info=True)
 
+    def write_message(self, message, binary=False):
+        # Small frames are not worth the deflate overhead.
+        if self._compressor is not None and self.ws_connection is not None \
+                and len(message) < self._compressor.min_size:
+            with self._compressor.skip(self.ws_connection):
+                return tornado.websocket.WebSocketHandler.write_message(
+                    self, message, binary)
+        return tornado.websocket.WebSocketHandler.write_message(
+            self, message, binary)
+
+    def stats(self):
+        stats = {
+            'remote_ip': self.request.remote_ip,
+            'encoding': self._encoding.name,
+            'compression': None,
+            'outbox': self._outbox.stats()
+        }
+        if self._compressor is not None:
+            stats['compression'] = self._compressor.stats.stats()
+        return stats
+
     def _send_response(self, response):
+        # Returns the write future (if tornado gives one) and frame size.
         try:
-            self.write_message(json.dumps(response))
+            if isinstance(response, encoding.PreEncoded):
+                message = response.frame(self._encoding,
+                                         metrics.encode.observe)
+            else:
+                start = time.time()
+                message = self._encoding.dumps(response)
+                metrics.encode.observe(time.time() - start)
+            future = self.write_message(message, binary=self._encoding.binary)
+            return future, len(message)
         except WebSocketClosedError:
             self._connected = False
+            # Nothing queued after this can go out either.
+            self._outbox.close()
             logging.warning("Dropping response to closed socket: %s",
                response, exc_info=True)
         except Exception as e:
             print "cant send", str(e)
             traceback.print_exc()
             print "RESPONSE", response.keys()
+        return None, 0
 
     def queue_response(self, response):
+        # calling write_message or the socket is not thread safe, so
+        # responses are queued and written together once per loop
+        # iteration, with a single callback for the whole batch.
         try:
-            # calling write_message or the socket is not thread safe
-            ioloop.add_callback(self._send_response, response)
+            self._outbox.put(response)
         except:
-            logging.error("Error adding callback", exc_info=True)
+            logging.error("Error queueing response", exc_info=True)
 
 class DebugConsole(threading.Thread):
 
@@ -190,9 +392,35 @@ class DebugConsole(threading.Thread):
         code.interact(local=dict(globals(), **locals()))
 
 def main(service):
-    application = GatewayApplication(service)
-    tornado.autoreload.start(ioloop)
-    application.listen(config.get('websocket-port', 8888))
+    port = config.get('websocket-port', 8888)
+    # Take client addresses from X-Real-Ip/X-Forwarded-For, for running
+    # behind a load balancer.
+    xheaders = config.get('xheaders', False)
+    # Nodes of a cluster share state over the cluster bus, they are not
+    # split into worker processes.
+    cluster_bus = cluster.cluster_bus()
+    if cluster_bus is not None:
+        if config.get('workers', 1) > 1:
+            logging.warning("workers is ignored in cluster mode")
+        application = GatewayApplication(service, cluster_bus)
+        application.listen(port, xheaders=xheaders)
+        reactor.run()
+        return
+    worker_count = config.get('workers', 1)
+    if worker_count > 1 and workers.worker_index() is None:
+        workers.run_master(worker_count, port)
+        return
+    if workers.worker_index() is not None:
+        # One of several processes sharing the port.
+        application = GatewayApplication(service, workers.worker_bus(port))
+        server = tornado.httpserver.HTTPServer(application,
+                                               xheaders=xheaders)
+        server.add_sockets(tornado.netutil.bind_sockets(port, reuse_port=True))
+        application.status_application.listen(workers.status_port(port))
+    else:
+        application = GatewayApplication(service)
+        tornado.autoreload.start(ioloop)
+        application.listen(port, xheaders=xheaders)
     #debug_console = DebugConsole(application)
     reactor.run()
 
@@ -0,0 +1,165 @@
+import struct
+import obelisk
+
+import cache
+from encoding import Binary
+
+HISTORY_CACHE_SIZE = 32 * 1024 * 1024
+# Addresses whose version is tracked before all of them are forgotten.
+MAX_VERSIONS = 100000
+# Rough JSON size of a translated history row, spent or not. Histories
+# are sized from their row count, encoding a busy address on every
+# update to measure it would stall the loop.
+ROW_SIZE = 150
+
+def history_size(history):
+    return len(history) * ROW_SIZE
+
+# Minimal transaction parsing, enough to apply an address update to a
+# cached history.
+
+def read_varint(data, offset):
+    size = ord(data[offset])
+    if size < 0xfd:
+        return size, offset + 1
+    if size == 0xfd:
+        return struct.unpack_from("<H", data, offset + 1)[0], offset + 3
+    if size == 0xfe:
+        return struct.unpack_from("<I", data, offset + 1)[0], offset + 5
+    return struct.unpack_from("<Q", data, offset + 1)[0], offset + 9
+
+def parse_transaction(tx):
+    """Returns ([(prev_hash, prev_index)], [(value, script)]) with hashes
+    wrapped the way they appear in a translated history."""
+    offset = 4
+    inputs = []
+    count, offset = read_varint(tx, offset)
+    for i in xrange(count):
+        prev_hash = Binary(tx[offset:offset + 32][::-1])
+        prev_index = struct.unpack_from("<I", tx, offset + 32)[0]
+        script_size, offset = read_varint(tx, offset + 36)
+        offset += script_size + 4
+        inputs.append((prev_hash, prev_index))
+    outputs = []
+    count, offset = read_varint(tx, offset)
+    for i in xrange(count):
+        value = struct.unpack_from("<Q", tx, offset)[0]
+        script_size, offset = read_varint(tx, offset + 8)
+        outputs.append((value, tx[offset:offset + script_size]))
+        offset += script_size
+    return inputs, outputs
+
+def script_hash160(script):
+    # Pay to pubkey hash
+    if len(script) == 25 and script[:3] == "\x76\xa9\x14" and \
+            script[23:] == "\x88\xac":
+        return script[3:23]
+    # Pay to script hash
+    if len(script) == 23 and script[:2] == "\xa9\x14" and \
+            script[22] == "\x87":
+        return script[2:22]
+    return None
+
+def row_in_range(row, from_height):
+    o_hash, o_index, o_height, value, s_hash, s_index, s_height = row
+    # Height 0 rows are unconfirmed and always newer than from_height.
+    if o_height == 0 or o_height >= from_height:
+        return True
+    return s_hash is not None and (s_height == 0 or s_height >= from_height)
+
+class HistoryCache(object):
+    """Translated full histories of subscribed addresses.
+
+    Entries are only kept while the address has an upstream subscription,
+    since updates from it are what keeps them current.
+    """
+
+    def __init__(self):
+        self._cache = cache.create_cache("history-cache-size",
+                                         HISTORY_CACHE_SIZE)
+        # Versions come from a counter that only grows. An address takes
+        # the next value on every update or discard, and addresses not
+        # listed are at the value taken by the last clear. A fetch that
+        # started before any of those carries an older version, so it
+        # does not store a stale history.
+        self._generation = 0
+        self._cleared = 0
+        self._versions = {}
+
+    def version(self, address):
+        return self._versions.get(address, self._cleared)
+
+    def _next_generation(self):
+        self._generation += 1
+        return self._generation
+
+    def _touch(self, address):
+        if len(self._versions) >= MAX_VERSIONS:
+            # Forgetting versions only fails fetches already running, the
+            # cached histories stay current.
+            self._cleared = self._next_generation()
+            self._versions.clear()
+        self._versions[address] = self._next_generation()
+
+    def get(self, address, from_height=0):
+        history = self._cache.get(address)
+        if history is None:
+            return None
+        if not from_height:
+            return history
+        return [row for row in history if row_in_range(row, from_height)]
+
+    def store(self, address, history, version):
+        if self.version(address) != version:
+            return
+        self._cache.put(address, history, history_size(history))
+
+    def discard(self, address):
+        self._touch(address)
+        self._cache.discard(address)
+
+    def clear(self):
+        self._cleared = self._next_generation()
+        self._versions.clear()
+        self._cache.clear()
+
+    def apply_update(self, address, height, tx):
+        self._touch(address)
+        history = self._cache.peek(address)
+        if history is None:
+            return
+        try:
+            history = self._apply(address, history, height, tx)
+        except Exception:
+            # Can't make sense of it, refetch on next request.
+            self._cache.discard(address)
+            return
+        self._cache.put(address, history, history_size(history))
+
+    def _apply(self, address, history, height, tx):
+        address_hash = obelisk.bitcoin.bc_address_to_hash_160(address)[1]
+        tx_hash = Binary(obelisk.Hash(tx)[::-1])
+        inputs, outputs = parse_transaction(tx)
+        history = list(history)
+        outpoints = {}
+        for i, row in enumerate(history):
+            outpoints[(row[0], row[1])] = i
+        for index, (value, script) in enumerate(outputs):
+            if script_hash160(script) != address_hash:
+                continue
+            i = outpoints.get((tx_hash, index))
+            if i is None:
+                history.append(
+                    (tx_hash, index, height, value, None, None, None))
+            else:
+                row = history[i]
+                history[i] = (row[0], row[1], height) + tuple(row[3:])
+        for index, outpoint in enumerate(inputs):
+            i = outpoints.get(outpoint)
+            if i is not None:
+                row = history[i]
+                history[i] = tuple(row[:4]) + (tx_hash, index, height)
+        return history
+
+    def stats(self):
+        return self._cache.stats()
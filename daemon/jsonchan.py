@@ -4,6 +4,9 @@ import logging
 import traceback
 from collections import defaultdict
 
+import metrics
+from encoding import PreEncoded
+
 VALID_SECTIONS = ['b', 'coinjoin', 'tmp', 'chat', 'identity', 'i']
 MAX_THREADS = 2000
 MAX_POSTS = 200
@@ -85,7 +88,8 @@ class JsonChanSection(object):
             thread = {'timestamp': time.time(), 'posts': [data]}
             self._threads[thread_id] = thread
         self.purge_threads()
-        self.notify_subscribers(thread_id, {'thread': thread_id, 'data': data, 'timestamp': thread['timestamp']})
+        # Serialized once and shared by every subscriber.
+        self.notify_subscribers(thread_id, PreEncoded({'type': 'chan_update', 'thread': thread_id, 'data': data, 'timestamp': thread['timestamp']}))
         return thread
 
     def get_thread(self, thread_id):
@@ -149,7 +153,7 @@ class ObJsonChanPost(JsonChanHandlerBase):
     def process(self, params):
         self._json_chan.post(params[0], params[1], params[2])
         self.process_response(None, {'result': 'ok', 'method': 'post'})
-        self._gateway.send_p2p(params);
+        self._gateway.share_post(params)
 
 class ObJsonChanList(JsonChanHandlerBase):
     def process(self, params):
@@ -172,13 +176,12 @@ class ObJsonChanSubscribe(JsonChanHandlerBase):
         self._handler._subscriptions['channel'][params[1]].append([params[0], self.send_notification])
         self.process_response(None, {'result': 'ok', 'method': 'subscribe', 'thread': params[1]})
 
-    def send_notification(self, data):
-        data['type'] = 'chan_update'
+    def send_notification(self, notification):
         if not self._handler.ws_connection or not self._handler._connected:
             raise ClientGone()
             #section = self._json_chan.get_section(self._params[0])
             #section.unsubscribe(self._params[1], self.send_notification)
-        self._handler.queue_response(data)
+        self._handler.queue_response(notification)
 
 class ObJsonChanUnsubscribe(JsonChanHandlerBase):
     def process(self, params):
@@ -200,15 +203,6 @@ class ObJsonChanUnsubscribe(JsonChanHandlerBase):
         else:
             self.process_response(None, {'result': 'error', 'error': 'Thread does not exist', 'thread': params[1]})
  
-class ObDisconnectClient(JsonChanHandlerBase):
-    def process(self, params):
-        for thread_id in self._handler._subscriptions['channel']:
-            for section_name, cb in self._handler._subscriptions['channel'][thread_id]:
-                section = self._json_chan.get_section(section_name)
-                section.unsubscribe(thread_id, cb)
- 
-        self._handler._subscriptions['channel'] = {}
-
 
 class JsonChanHandler:
 
@@ -217,41 +211,87 @@ class JsonChanHandler:
         "chan_list":                ObJsonChanList,
         "chan_get":                 ObJsonChanGet,
         "chan_subscribe":           ObJsonChanSubscribe,
-        "chan_unsubscribe":         ObJsonChanUnsubscribe,
-        "disconnect_client":        ObDisconnectClient
+        "chan_unsubscribe":         ObJsonChanUnsubscribe
     }
 
-    def __init__(self, p2p):
+    def __init__(self, bus=None):
         self._json_chan = JsonChan()
+        # With a bus only the leader is on the p2p network, the others
+        # get and share posts over the bus.
+        self._p2p = None
+        self._bus = bus
+        if bus is not None:
+            bus.subscribe('chan_post', self.on_bus_post)
+
+    def set_p2p(self, p2p):
         self._p2p = p2p
         p2p.add_callback('jsonchan', self.on_p2p_message)
 
+    def on_p2p(self):
+        # A former leader stays on the network but no longer relays.
+        if self._p2p is None:
+            return False
+        return self._bus is None or self._bus.is_leader()
+
+    def register(self, commands):
+        for command in self.handlers:
+            commands.register(command, self.handle_request)
+        commands.add_disconnect_listener(self.disconnect_client)
+
+    def disconnect_client(self, socket_handler):
+        for thread_id in socket_handler._subscriptions['channel']:
+            for section_name, cb in socket_handler._subscriptions['channel'][thread_id]:
+                section = self._json_chan.get_section(section_name)
+                section.unsubscribe(thread_id, cb)
+
+        socket_handler._subscriptions['channel'] = {}
+
+    def share_post(self, params):
+        if self._bus is not None:
+            self._bus.publish('chan_post', *params)
+        if self.on_p2p():
+            self.send_p2p(params)
+
     def send_p2p(self, params):
         msg = {'type': 'jsonchan', 'action': 'post', 'data': params}
         self._p2p.send(msg, secure=True)
 
+    def on_bus_post(self, node, section_name, thread_id, data):
+        self._json_chan.post(section_name, thread_id, data)
+        if self.on_p2p():
+            self.send_p2p([section_name, thread_id, data])
+
     def on_p2p_message(self, data):
+        if not self.on_p2p():
+            return
         if data.get('action') == 'post' and data.get('data'):
             params = data.get('data')
             if len(params) == 3:
                 self._json_chan.post(params[0], params[1], params[2])
+                if self._bus is not None:
+                    self._bus.publish('chan_post', *params)
 
     def handle_request(self, socket_handler, request):
         command = request["command"]
         if command not in self.handlers:
             return False
         params = request["params"]
+        timer = metrics.commands.start(command)
         # Create callback handler to write response to the socket.
         handler = self.handlers[command](socket_handler, request["id"], self._json_chan, self)
         try:
             params = handler.translate_arguments(params)
         except Exception as exc:
             logging.error("Bad parameters specified: %s", exc, exc_info=True)
+            timer.finish(str(exc))
             return True
         try:
             handler.process(params)
         except Exception as e:
             handler.process_response(str(e), {})
+            timer.finish(str(e))
+            return True
+        timer.finish()
         return True
 
 if __name__ == '__main__':
@@ -0,0 +1,245 @@
+import time
+import logging
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Upper bounds in seconds, the last bucket catches everything above.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation.
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99)
+        }
+
+class CommandStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.inflight = 0
+        self.backend = Histogram()
+        self.total = Histogram()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'inflight': self.inflight,
+            'backend': self.backend.stats(),
+            'total': self.total.stats()
+        }
+
+class RequestTimer(object):
+    """Follows one request from dispatch to its (first) response."""
+
+    def __init__(self, command_stats):
+        self._stats = command_stats
+        self._start = time.time()
+        self._finished = False
+        self._on_finish = []
+        command_stats.requests += 1
+        command_stats.inflight += 1
+
+    def add_finish_callback(self, callback):
+        self._on_finish.append(callback)
+
+    def backend_done(self):
+        self._stats.backend.observe(time.time() - self._start)
+
+    def finish(self, error=None):
+        if self._finished:
+            return
+        self._finished = True
+        self._stats.inflight -= 1
+        if error:
+            self._stats.errors += 1
+        self._stats.total.observe(time.time() - self._start)
+        for callback in self._on_finish:
+            try:
+                callback()
+            except:
+                logging.error("Error in request timer callback",
+                              exc_info=True)
+
+class TimerClaim(object):
+
+    def __init__(self, command, callback):
+        self.command = command
+        self.callback = callback
+        self.taken = False
+
+class CommandMetrics(object):
+
+    def __init__(self):
+        self._commands = defaultdict(CommandStats)
+        # Handed to the next timer started for its command.
+        self._claim = None
+
+    def start(self, command):
+        timer = RequestTimer(self._commands[command])
+        claim = self._claim
+        if claim is not None and not claim.taken and claim.command == command:
+            claim.taken = True
+            timer.add_finish_callback(claim.callback)
+        return timer
+
+    @contextmanager
+    def claim_next(self, command, callback):
+        """Runs callback once the first timer started for command inside
+        the block finishes. If the block starts none, claim.taken stays
+        False and callback is up to the caller."""
+        previous = self._claim
+        claim = TimerClaim(command, callback)
+        self._claim = claim
+        try:
+            yield claim
+        finally:
+            self._claim = previous
+
+    def inflight(self, command):
+        command_stats = self._commands.get(command)
+        if command_stats is None:
+            return 0
+        return command_stats.inflight
+
+    def stats(self):
+        return dict((command, command_stats.stats())
+                    for command, command_stats in self._commands.items())
+
+    def collect(self):
+        requests = Metric("gateway_requests_total", "counter",
+                          "Requests received per command")
+        errors = Metric("gateway_request_errors_total", "counter",
+                        "Requests answered with an error per command")
+        inflight = Metric("gateway_requests_inflight", "gauge",
+                          "Requests waiting for a reply per command")
+        backend = Metric("gateway_backend_seconds", "histogram",
+                         "Time from dispatch to backend reply")
+        total = Metric("gateway_request_seconds", "histogram",
+                       "Time from dispatch to response")
+        for command, command_stats in self._commands.items():
+            requests.add(command_stats.requests, command=command)
+            errors.add(command_stats.errors, command=command)
+            inflight.add(command_stats.inflight, command=command)
+            backend.add_histogram(command_stats.backend, command=command)
+            total.add_histogram(command_stats.total, command=command)
+        return [requests, errors, inflight, backend, total]
+
+def escape_label(value):
+    return unicode(value).replace("\\", "\\\\").replace(
+        "\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape_label(value))
+                             for name, value in sorted(labels.items()))
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric(object):
+    """Snapshot of one metric family, ready to be rendered.
+
+    Values are copied when added so rendering can happen away from the
+    event loop.
+    """
+
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.samples = []
+
+    def add(self, value, **labels):
+        self.samples.append((self.name, labels, value))
+        return self
+
+    def add_histogram(self, histogram, **labels):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),),
+                                histogram.counts):
+            cumulative += count
+            self.samples.append((self.name + "_bucket",
+                                 dict(labels, le=format_value(bound)),
+                                 cumulative))
+        self.samples.append((self.name + "_sum", labels, histogram.sum))
+        self.samples.append((self.name + "_count", labels, histogram.count))
+        return self
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for name, labels, value in self.samples:
+            lines.append("%s%s %s" % (name, format_labels(labels),
+                                      format_value(value)))
+        return "\n".join(lines)
+
+class Registry(object):
+    """Subsystems register collectors, callables returning a list of
+    Metric snapshots."""
+
+    def __init__(self):
+        self._collectors = []
+
+    def register(self, collector):
+        self._collectors.append(collector)
+
+    def collect(self):
+        metrics = []
+        for collector in self._collectors:
+            try:
+                metrics.extend(collector())
+            except:
+                logging.error("Error collecting metrics", exc_info=True)
+        return metrics
+
+def render(metrics):
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+def collect_encode():
+    return [Metric("gateway_encode_seconds", "histogram",
+                   "Time spent encoding responses").add_histogram(encode)]
+
+# Shared by every handler.
+commands = CommandMetrics()
+# Time spent encoding responses before writing them to the socket.
+encode = Histogram()
+
+registry = Registry()
+registry.register(commands.collect)
+registry.register(collect_encode)
@@ -1,34 +1,185 @@
 from twisted.internet import reactor
 
+import json
 import logging
+import weakref
 import obelisk
+from collections import defaultdict
+from functools import partial
+
+import cache
+import chain
+import config
+import history_cache
+from encoding import Binary
+import metrics
+import pager
+import scheduler
+import stealth_index
+import subscriptions
+import throttle
+
+HISTORY_MULTI_CONCURRENCY = 8
+HISTORY_MULTI_MAX_SIZE = 500
+# Rows per frame when fetch_history is paginated.
+HISTORY_PAGE_SIZE = 1000
+HISTORY_MAX_PAGE_SIZE = 10000
+
+# Seconds to wait for the backend before answering with a timeout.
+REQUEST_TIMEOUT = 30
+REQUEST_TIMEOUTS = {
+    "fetch_history":        60,
+    "fetch_history_multi":  300,
+    "fetch_stealth":        120,
+    "fetch_stealth2":       120
+}
+
+# Relative weight of a request, lookups not listed cost 1. Scans from
+# the genesis block cost a lot more than incremental ones.
+FULL_HISTORY_COST = 10
+HISTORY_COST = 2
+FULL_STEALTH_COST = 50
+STEALTH_COST = 10
+
+def history_cost(params):
+    if len(params) > 1 and params[1]:
+        return HISTORY_COST
+    return FULL_HISTORY_COST
+
+def history_multi_cost(params):
+    return sum(history_cost(item) if type(item) == list else 1
+               for item in params)
+
+def stealth_cost(params):
+    if len(params) > 1 and params[1]:
+        return STEALTH_COST
+    return FULL_STEALTH_COST
+
+COMMAND_COSTS = {
+    "fetch_history":                    history_cost,
+    "fetch_history_multi":              history_multi_cost,
+    "fetch_block_transaction_hashes":   2,
+    "fetch_stealth":                    stealth_cost,
+    "fetch_stealth2":                   stealth_cost
+}
 
 class ObeliskCallbackBase(object):
 
-    def __init__(self, handler, request_id, client, legacy_server):
+    def __init__(self, handler, request_id, client, legacy_server,
+                 gateway=None):
         self._handler = handler
         self._request_id = request_id
         self._client = client
         self._legacy_server = legacy_server
+        self._gateway = gateway
+        self._cache = None
+        self._cache_key = None
+        self._inflight = None
+        self._inflight_key = None
+        self._waiters = []
+        self._deadline = None
+        self._done = False
+        self._timer = None
+
+    def set_cache(self, cache, key):
+        self._cache = cache
+        self._cache_key = key
+
+    def set_inflight(self, inflight, key):
+        # Identical requests arriving while this one is pending attach
+        # themselves as waiters instead of going upstream again.
+        self._inflight = inflight
+        self._inflight_key = key
+        inflight[key] = self
+
+    def set_timer(self, timer):
+        self._timer = timer
+
+    def is_cancelled(self):
+        # Answered already (deadline) or nobody is left to answer.
+        if self._done:
+            return True
+        handlers = [self._handler] + [waiter[0] for waiter in self._waiters]
+        return not any(getattr(handler, "_connected", True)
+                       for handler in handlers)
+
+    def cancel(self):
+        self.respond("cancelled", None)
+
+    def finish_timer(self, error=None):
+        # For requests dropped without a response.
+        self._done = True
+        self._cancel_deadline()
+        if self._timer is not None:
+            self._timer.finish(error)
+
+    def add_waiter(self, handler, request_id, timer=None):
+        self._waiters.append((handler, request_id, timer))
+
+    def set_deadline(self, timeout, on_timeout):
+        def expire():
+            self._deadline = None
+            on_timeout()
+            self.respond("timeout", None)
+        self._deadline = reactor.callLater(timeout, expire)
 
     def __call__(self, *args):
+        if self._done:
+            # Late reply after the deadline expired.
+            return
+        if self._timer is not None:
+            self._timer.backend_done()
         assert len(args) > 1
         error = args[0]
         assert error is None or type(error) == str
         result = self.translate_response(args[1:])
-        response = {
-            "id": self._request_id,
-            "error": error,
-            "result": result
-        }
-        self._handler.queue_response(response)
+        self.respond(error, result)
+
+    def _cancel_deadline(self):
+        if self._deadline is not None:
+            if self._deadline.active():
+                self._deadline.cancel()
+            self._deadline = None
+
+    def respond(self, error, result):
+        if self._done:
+            return
+        self._done = True
+        self._cancel_deadline()
+        if error is None and self._cache_key is not None:
+            self._cache.put(self._cache_key, result)
+        if self._inflight is not None:
+            if self._inflight.get(self._inflight_key) is self:
+                del self._inflight[self._inflight_key]
+            self._inflight = None
+        self.send_result(error, result)
+        # The backend client may hold on to this callback forever, so let
+        # go of the socket.
+        self._handler = None
+
+    def send_result(self, error, result):
+        waiters = [(self._handler, self._request_id, self._timer)] + \
+            self._waiters
+        self._waiters = []
+        for handler, request_id, timer in waiters:
+            response = {
+                "id": request_id,
+                "error": error,
+                "result": result
+            }
+            handler.queue_response(response)
+            if timer is not None:
+                timer.finish(error)
 
     def call_method(self, method, params):
         method(*params, cb=self)
 
     def call_client_method(self, method_name, params):
         method = getattr(self._client, method_name)
-        self.call_method(method, params)
+        try:
+            self.call_method(method, params)
+        except scheduler.Overloaded as exc:
+            self.respond(str(exc), None)
 
     def translate_arguments(self, params):
         return params
@@ -48,6 +199,14 @@ def decode_hash(encoded_hash):
         raise ValueError("Not a hash")
     return decoded_hash
 
+def check_address(address):
+    if not isinstance(address, basestring):
+        raise ValueError("Invalid address")
+    try:
+        obelisk.bitcoin.bc_address_to_hash_160(str(address))
+    except Exception:
+        raise ValueError("Invalid address")
+
 def unpack_index(index):
     if type(index) == unicode:
         index = str(index)
@@ -76,91 +235,229 @@ class ObFetchTransaction(ObeliskCallbackBase):
 
     def translate_response(self, result):
         assert len(result) == 1
-        tx = result[0].encode("hex")
+        tx = Binary(result[0])
         return (tx,)
 
 class ObUnsubscribe(ObeliskCallbackBase):
+
+    def call_client_method(self, method_name, params):
+        self._gateway.subscriptions.unsubscribe(params[0], self._handler,
+                                                self)
+
     def translate_arguments(self, params):
         check_params_length(params, 1)
-        address = params[0]
-        cb = None
-        if address in self._handler._subscriptions['obelisk']:
-            cb = self._handler._subscriptions['obelisk'][address]
-            del self._handler._subscriptions['obelisk'][address]
-        return (address, cb)
+        check_address(params[0])
+        return params
 
 class ObSubscribe(ObeliskCallbackBase):
 
-    def __call__(self, err, data):
-        if self._initial:
-            # only notify the client on initial subscription, not renew
-            ObeliskCallbackBase.__call__(self, err, data)
-            self._initial = False
-
-        # schedule renew for subscription
-        if self._handler._connected:
-            if not self._address in self._handler._subscriptions['obelisk']:
-                self._handler._subscriptions['obelisk'][self._address] = self.callback_update
-            reactor.callLater(120, self.renew)
-
-    def renew(self, *args):
-        if self._handler._connected:
-            self.call_client_method('renew_address', [self._address])
+    def call_client_method(self, method_name, params):
+        # Both subscribe_address and renew_address end up here, renewal of
+        # the upstream subscription is handled by the multiplexer.
+        if not self._handler._connected:
+            self.finish_timer()
+            return
+        self._gateway.subscriptions.subscribe(params[0], self._handler, self)
+
+    def respond(self, error, result):
+        if error == "timeout" and not self._done:
+            # Don't leave the reply waiting on the upstream subscription.
+            self._gateway.subscriptions.forget_reply(self._address, self)
+        ObeliskCallbackBase.respond(self, error, result)
 
     def translate_arguments(self, params):
-        # this gets called only on the initial invokation to subscribe.
         check_params_length(params, 1)
+        # Checked before anything is registered, the client would raise
+        # only once the subscription is half set up.
+        check_address(params[0])
         self._address = params[0]
-        self._initial = True
-        return params[0], self.callback_update
-
-    def callback_update(self, address_version, address_hash,
-                        height, block_hash, tx):
-        address = obelisk.bitcoin.hash_160_to_bc_address(
-            address_hash, address_version)
-
-        response = {
-            "type": "update",
-            "address": address,
-            "height": height,
-            "block_hash": block_hash.encode('hex'),
-            "tx": tx.encode("hex")
-        }
-        try:
-            # self._socket.write_message(json.dumps(response))
-            self._handler.queue_response(response)
-        except:
-            logging.error("Error sending message", exc_info=True)
+        return params
 
 
+class ObSubscribeBlocks(ObeliskCallbackBase):
+
+    def call_client_method(self, method_name, params):
+        if not self._handler._connected:
+            self.finish_timer()
+            return
+        self._gateway.block_subscriptions.subscribe(self._handler)
+        self.respond(None, (self._gateway.chain.height,))
+
+class ObUnsubscribeBlocks(ObeliskCallbackBase):
+
+    def call_client_method(self, method_name, params):
+        unsubscribed = self._gateway.block_subscriptions.unsubscribe(
+            self._handler)
+        self.respond(None, (unsubscribed,))
+
 class ObFetchHistory(ObeliskCallbackBase):
 
+    def call_client_method(self, method_name, params):
+        address, from_height = params
+        if self._cursor is not None:
+            # Follow-up page, cut from what the first page left behind.
+            rows = self._gateway.history_snapshots.get(address, from_height)
+            if rows is not None:
+                self._sorted = True
+                self.respond(None, (rows,))
+                return
+        if self._gateway.subscriptions.is_upstream(address):
+            history = self._gateway.history_cache.get(address, from_height)
+            if history is not None:
+                self.respond(None, (history,))
+                return
+            # Fetch everything so the cache can serve any height later on.
+            self._history_version = \
+                self._gateway.history_cache.version(address)
+            params = (address, 0)
+        ObeliskCallbackBase.call_client_method(self, method_name, params)
+
+    def respond(self, error, result):
+        address, from_height = self._params
+        if self._history_version is not None and error is None:
+            self._gateway.history_cache.store(address, result[0],
+                                              self._history_version)
+            if from_height:
+                result = ([row for row in result[0]
+                           if history_cache.row_in_range(row, from_height)],)
+        ObeliskCallbackBase.respond(self, error, result)
+
+    def send_result(self, error, result):
+        if not self._page_size or error is not None:
+            ObeliskCallbackBase.send_result(self, error, result)
+            return
+        waiters = [(self._handler, self._request_id, self._timer)] + \
+            self._waiters
+        self._waiters = []
+        rows = result[0]
+        if not self._sorted:
+            rows = pager.sort_rows(rows)
+            start = 0
+            if self._cursor is not None:
+                start = pager.find_after(rows, self._cursor)
+            # Keep the rest around when the client has to come back for
+            # it, instead of fetching the whole history for every page.
+            if self._max_pages and \
+                    len(rows) - start > self._page_size * self._max_pages:
+                address, from_height = self._params
+                self._gateway.history_snapshots.put(address, from_height,
+                                                    rows)
+        pager.Pager(waiters, rows, self._page_size, self._cursor,
+                    self._max_pages).start()
+
     def call_method(self, method, params):
         assert len(params) == 2
         address, from_height = params
         method(address, self, from_height)
 
     def translate_arguments(self, params):
-        if len(params) != 1 and len(params) != 2:
+        # [address, from_height, page_size, cursor, max_pages]
+        if not 1 <= len(params) <= 5:
             raise ValueError("Invalid parameter list length")
         address = params[0]
-        if len(params) == 2:
+        check_address(address)
+        if len(params) >= 2:
             from_height = params[1]
         else:
             from_height = 0
+        self._page_size = 0
+        self._cursor = None
+        self._max_pages = 0
+        if len(params) >= 3 and params[2]:
+            self._page_size = min(int(params[2]),
+                                  self._gateway.history_max_page_size)
+            if self._page_size <= 0:
+                raise ValueError("Invalid page size")
+            if len(params) >= 4 and params[3]:
+                self._cursor = pager.parse_cursor(params[3])
+            if len(params) >= 5:
+                self._max_pages = int(params[4])
+            if self._max_pages < 0:
+                raise ValueError("Invalid page count")
+        self._params = (address, from_height)
+        self._history_version = None
+        self._sorted = False
         return (address, from_height)
 
     def translate_response(self, result):
         assert len(result) == 1
-        history = []
-        for row in result[0]:
-            o_hash, o_index, o_height, value, s_hash, s_index, s_height = row
-            o_hash = o_hash.encode("hex")
-            if s_hash is not None:
-                s_hash = s_hash.encode("hex")
-            history.append(
-                (o_hash, o_index, o_height, value, s_hash, s_index, s_height))
-        return (history,)
+        return ([translate_history_row(row) for row in result[0]],)
+
+def translate_history_row(row):
+    o_hash, o_index, o_height, value, s_hash, s_index, s_height = row
+    o_hash = Binary(o_hash)
+    if s_hash is not None:
+        s_hash = Binary(s_hash)
+    return (o_hash, o_index, o_height, value, s_hash, s_index, s_height)
+
+class ObFetchHistoryMulti(ObeliskCallbackBase):
+
+    # Each sub-query goes through ObeliskHandler as a regular fetch_history
+    # with this object standing in as the socket handler.
+
+    @property
+    def _connected(self):
+        # Gone once answered, or once the real socket is.
+        return self._handler is not None and \
+            getattr(self._handler, "_connected", True)
+
+    def call_client_method(self, method_name, params):
+        self._rows = [None] * len(params)
+        self._remaining = len(params)
+        if not params:
+            self.respond(None, ([],))
+            return
+        self._limiter = self._gateway.history_limiter(self._handler)
+        # index -> release of the limiter slot the entry runs in
+        self._releases = {}
+        for index, (address, from_height) in enumerate(params):
+            request = {
+                "id": index,
+                "command": "fetch_history",
+                "params": [address, from_height]
+            }
+            self._limiter.submit(partial(self._run_entry, request),
+                                 self._entry_cancelled)
+
+    def _run_entry(self, request, release):
+        self._releases[request["id"]] = release
+        self._gateway.handle_request(self, request)
+
+    def _entry_cancelled(self):
+        # Entries still queued when the client goes away are not run.
+        if not self.is_cancelled():
+            return False
+        self.cancel()
+        return True
+
+    def queue_response(self, response):
+        index = response["id"]
+        address = self._params[index][0]
+        history = response["result"][0] if response["result"] else None
+        self._rows[index] = (address, response["error"], history)
+        self._remaining -= 1
+        # Queued entries may start, and even answer, from in here.
+        release = self._releases.pop(index, None)
+        if release is not None:
+            release()
+        if self._remaining == 0:
+            self.respond(None, (self._rows,))
+
+    def translate_arguments(self, params):
+        if len(params) > self._gateway.history_multi_max:
+            raise ValueError("Too many addresses")
+        pairs = []
+        for item in params:
+            # [address, from_height], no page size since every entry must
+            # answer with a single frame.
+            if type(item) != list or len(item) not in (1, 2):
+                raise ValueError("Invalid address entry")
+            if len(item) == 2:
+                pairs.append((item[0], item[1]))
+            else:
+                pairs.append((item[0], 0))
+        self._params = pairs
+        return pairs
 
 class ObFetchBlockHeader(ObeliskCallbackBase):
 
@@ -171,7 +468,7 @@ class ObFetchBlockHeader(ObeliskCallbackBase):
 
     def translate_response(self, result):
         assert len(result) == 1
-        header = result[0].encode("hex")
+        header = Binary(result[0])
         return (header,)
 
 class ObFetchBlockTransactionHashes(ObeliskCallbackBase):
@@ -186,7 +483,7 @@ class ObFetchBlockTransactionHashes(ObeliskCallbackBase):
         tx_hashes = []
         for tx_hash in result[0]:
             assert len(tx_hash) == 32
-            tx_hashes.append(tx_hash.encode("hex"))
+            tx_hashes.append(Binary(tx_hash))
         return (tx_hashes,)
 
 class ObFetchSpend(ObeliskCallbackBase):
@@ -203,7 +500,7 @@ class ObFetchSpend(ObeliskCallbackBase):
     def translate_response(self, result):
         assert len(result) == 1
         outpoint = result[0]
-        outpoint = (outpoint.hash.encode("hex"), outpoint.index)
+        outpoint = (Binary(outpoint.hash), outpoint.index)
         return (outpoint,)
 
 class ObFetchTransactionIndex(ObeliskCallbackBase):
@@ -229,7 +526,14 @@ class ObFetchStealth(ObeliskCallbackBase):
 
     def on_stealth_response(self, msg):
         print "Websocket stealth response"
+        if self._done:
+            # Answered with a timeout already.
+            return
+        self._done = True
+        self._cancel_deadline()
         self._handler.queue_response(msg)
+        if self._timer is not None:
+            self._timer.finish(msg.get("error"))
 
     def call_client_method(self, method_name, params):
         assert len(params) == 2
@@ -263,7 +567,22 @@ class ObFetchStealth2(ObeliskCallbackBase):
         # Workaround for difference in api among libbitcoin versions
         if prefix == [0,0]:
             prefix = [0]
-        method(prefix, self, from_height)
+        # Only scan the part the stealth index doesn't cover yet.
+        tip = self._gateway.chain.height
+        rows, tail = self._gateway.stealth_index.lookup(
+            prefix, from_height, tip)
+        if tail is None:
+            self.respond(None, (rows,))
+            return
+        self._stealth_scan = (prefix, tail, tip, rows)
+        method(prefix, self, tail)
+
+    def respond(self, error, result):
+        if self._stealth_scan is not None and error is None:
+            prefix, tail, tip, rows = self._stealth_scan
+            self._gateway.stealth_index.store(prefix, tail, tip, result[0])
+            result = (stealth_index.merge_rows(rows, result[0]),)
+        ObeliskCallbackBase.respond(self, error, result)
 
     def translate_arguments(self, params):
         if len(params) != 1 and len(params) != 2:
@@ -273,6 +592,7 @@ class ObFetchStealth2(ObeliskCallbackBase):
             from_height = params[1]
         else:
             from_height = 0
+        self._stealth_scan = None
         return (prefix, from_height)
 
     def translate_response(self, result):
@@ -280,23 +600,18 @@ class ObFetchStealth2(ObeliskCallbackBase):
         stealth_results = []
         for ephemkey, address, tx_hash in result[0]:
             stealth_results.append(
-                (ephemkey[::-1].encode("hex"), obelisk.bitcoin.hash_160_to_bc_address(address[::-1]), tx_hash.encode("hex")))
+                (Binary(ephemkey[::-1]), obelisk.bitcoin.hash_160_to_bc_address(address[::-1]), Binary(tx_hash)))
         return (stealth_results,)
 
 
 
-class ObDisconnectClient(ObeliskCallbackBase):
-    def call_client_method(self, method_name, params):
-        for address in self._handler._subscriptions['obelisk']:
-            self._client.unsubscribe_address(address, self._handler._subscriptions['obelisk'][address])
-            # TODO: could also unsubscribe other callbacks from this client
-
 class ObeliskHandler:
 
     handlers = {
         "fetch_last_height":                ObFetchLastHeight,
         "fetch_transaction":                ObFetchTransaction,
         "fetch_history":                    ObFetchHistory,
+        "fetch_history_multi":              ObFetchHistoryMulti,
         "fetch_block_header":               ObFetchBlockHeader,
         "fetch_block_transaction_hashes":   ObFetchBlockTransactionHashes,
         "fetch_spend":                      ObFetchSpend,
@@ -308,12 +623,223 @@ class ObeliskHandler:
         "renew_address":                    ObSubscribe,
         "subscribe_address":                ObSubscribe,
         "unsubscribe_address":              ObUnsubscribe,
-        "disconnect_client":                ObDisconnectClient
+        # Block stuff
+        "subscribe_blocks":                 ObSubscribeBlocks,
+        "unsubscribe_blocks":               ObUnsubscribeBlocks
     }
 
-    def __init__(self, client, legacy_server):
-        self._client = client
+    # Lookups keyed by a hash whose answer never changes, so the translated
+    # result can be served from memory.
+    cacheable = set([
+        "fetch_transaction",
+        "fetch_block_header",
+        "fetch_block_transaction_hashes",
+        "fetch_transaction_index",
+        "fetch_block_height"
+    ])
+
+    # Read-only queries where concurrent identical requests can share a
+    # single upstream call.
+    coalescable = set([
+        "fetch_last_height",
+        "fetch_transaction",
+        "fetch_history",
+        "fetch_block_header",
+        "fetch_block_transaction_hashes",
+        "fetch_spend",
+        "fetch_transaction_index",
+        "fetch_block_height",
+        "fetch_stealth2"
+    ])
+
+    def __init__(self, client, legacy_server, bus=None):
+        # Requests go upstream through the scheduler, background work
+        # (chain polling, subscriptions) talks to the client directly.
+        self.scheduler = scheduler.Scheduler(client)
+        self._client = self.scheduler
         self._legacy_server = legacy_server
+        self._cache = cache.create_cache("cache-size")
+        # Only the leader follows the chain, the others hear of new
+        # blocks over the bus.
+        self.chain = chain.ChainTracker(client, bus)
+        self.chain.add_reorg_listener(self._on_reorg)
+        self.block_subscriptions = subscriptions.BlockSubscriptions(self.chain)
+        self.history_cache = history_cache.HistoryCache()
+        self.history_snapshots = pager.HistorySnapshots()
+        self.stealth_index = stealth_index.StealthIndex()
+        self.subscriptions = subscriptions.AddressSubscriptions(
+            client, self.history_cache, bus)
+        # (command, params) -> pending callback
+        self._inflight = {}
+        self.coalesced = 0
+        # Per connection limits for fetch_history_multi.
+        self._history_limiters = weakref.WeakKeyDictionary()
+        self._history_concurrency = config.get(
+            "history-multi-concurrency", HISTORY_MULTI_CONCURRENCY)
+        self.history_multi_max = config.get(
+            "history-multi-max-size", HISTORY_MULTI_MAX_SIZE)
+        self.history_page_size = config.get(
+            "history-page-size", HISTORY_PAGE_SIZE)
+        self.history_max_page_size = config.get(
+            "history-max-page-size", HISTORY_MAX_PAGE_SIZE)
+        self._timeouts = dict(REQUEST_TIMEOUTS)
+        self._timeouts.update(config.get("request-timeouts", {}))
+        self._default_timeout = config.get("request-timeout", REQUEST_TIMEOUT)
+        self.timeouts = defaultdict(int)
+        metrics.registry.register(self.collect_metrics)
+
+    def _cache_key(self, command, params):
+        if command not in self.cacheable:
+            return None
+        # Only hash indexes are cached, heights can be reorganised.
+        if len(params) != 1 or not isinstance(params[0], basestring):
+            return None
+        return (command, params[0].lower())
+
+    def _local_result(self, command, params):
+        # Answers from the chain tracker, no backend round trip needed.
+        if command == "fetch_last_height":
+            if self.chain.height is not None:
+                return (self.chain.height,)
+            return None
+        if not params or len(params) != 1:
+            return None
+        index = params[0]
+        if command == "fetch_block_header":
+            if isinstance(index, (int, long)):
+                header = self.chain.header_by_height(index)
+            elif isinstance(index, basestring):
+                header = self.chain.header_by_hash(index.lower())
+            else:
+                header = None
+            if header is not None:
+                return (header,)
+        elif command == "fetch_block_height" and \
+                isinstance(index, basestring):
+            height = self.chain.height_by_hash(index.lower())
+            if height is not None:
+                return (height,)
+        return None
+
+    def _on_reorg(self, fork_height):
+        # Transaction indexes and histories may point at orphaned blocks.
+        self._cache.clear()
+        self.history_cache.clear()
+        self.history_snapshots.clear()
+        self.stealth_index.clear()
+
+    def _inflight_key(self, command, params):
+        if command not in self.coalescable:
+            return None
+        try:
+            return (command, json.dumps(params, sort_keys=True))
+        except (TypeError, ValueError):
+            return None
+
+    def history_limiter(self, socket_handler):
+        limiter = self._history_limiters.get(socket_handler)
+        if limiter is None:
+            limiter = throttle.ConcurrencyLimiter(self._history_concurrency)
+            self._history_limiters[socket_handler] = limiter
+        return limiter
+
+    def _on_timeout(self, command):
+        logging.warning("Backend request timed out: %s", command)
+        self.timeouts[command] += 1
+
+    def cache_stats(self):
+        return self._cache.stats()
+
+    def inflight_stats(self):
+        return {
+            'pending': len(self._inflight),
+            'coalesced': self.coalesced,
+            'timeouts': dict(self.timeouts)
+        }
+
+    def collect_metrics(self):
+        Metric = metrics.Metric
+        collected = []
+        for name, stats in (("cache", self._cache.stats()),
+                            ("history_cache", self.history_cache.stats()),
+                            ("history_snapshots",
+                             self.history_snapshots.stats()),
+                            ("stealth_index", self.stealth_index.stats())):
+            collected += [
+                Metric("gateway_%s_entries" % name, "gauge",
+                       "Entries held in the %s" % name)
+                    .add(stats['entries']),
+                Metric("gateway_%s_bytes" % name, "gauge",
+                       "Bytes held in the %s" % name)
+                    .add(stats['bytes']),
+                Metric("gateway_%s_hits_total" % name, "counter",
+                       "Lookups served from the %s" % name)
+                    .add(stats['hits']),
+                Metric("gateway_%s_misses_total" % name, "counter",
+                       "Lookups missing the %s" % name)
+                    .add(stats['misses']),
+                Metric("gateway_%s_evictions_total" % name, "counter",
+                       "Entries evicted from the %s" % name)
+                    .add(stats['evictions'])
+            ]
+        timeouts = Metric("gateway_backend_timeouts_total", "counter",
+                          "Backend requests that hit their deadline")
+        for command, count in self.timeouts.items():
+            timeouts.add(count, command=command)
+        subscriptions = self.subscriptions.stats()
+        renewals = subscriptions['renewals']
+        chain_stats = self.chain.stats()
+        collected += [
+            Metric("gateway_chain_height", "gauge",
+                   "Height of the chain tip")
+                .add(chain_stats['height']),
+            Metric("gateway_chain_headers", "gauge",
+                   "Recent headers held in memory")
+                .add(chain_stats['headers']),
+            Metric("gateway_chain_reorgs_total", "counter",
+                   "Chain reorganizations seen")
+                .add(chain_stats['reorgs']),
+            Metric("gateway_block_subscribers", "gauge",
+                   "Sockets subscribed to new blocks")
+                .add(self.block_subscriptions.stats()['subscribers']),
+            Metric("gateway_backend_pending", "gauge",
+                   "Distinct queries waiting for the backend")
+                .add(len(self._inflight)),
+            Metric("gateway_coalesced_total", "counter",
+                   "Requests attached to an identical pending query")
+                .add(self.coalesced),
+            timeouts,
+            Metric("gateway_subscribed_addresses", "gauge",
+                   "Addresses with an upstream subscription")
+                .add(subscriptions['addresses']),
+            Metric("gateway_address_subscribers", "gauge",
+                   "Local address subscriptions")
+                .add(subscriptions['subscribers']),
+            Metric("gateway_address_updates_total", "counter",
+                   "Address updates received from the backend")
+                .add(subscriptions['updates']),
+            Metric("gateway_renewal_queue_depth", "gauge",
+                   "Subscriptions scheduled for renewal")
+                .add(renewals['depth']),
+            Metric("gateway_renewal_rate", "gauge",
+                   "Subscription renewals per second")
+                .add(renewals['rate']),
+            Metric("gateway_renewals_total", "counter",
+                   "Subscription renewals sent")
+                .add(renewals['fired'])
+        ]
+        return collected
+
+    def register(self, commands):
+        for command in self.handlers:
+            commands.register(command, self.handle_request,
+                              cost=COMMAND_COSTS.get(command, 1),
+                              cacheable=command in self.cacheable)
+        commands.add_disconnect_listener(self.disconnect_client)
+
+    def disconnect_client(self, socket_handler):
+        self.subscriptions.unsubscribe_all(socket_handler)
+        self.block_subscriptions.unsubscribe(socket_handler)
 
     def handle_request(self, socket_handler, request):
         command = request["command"]
@@ -321,13 +847,48 @@ class ObeliskHandler:
             return False
 
         params = request["params"]
+        timer = metrics.commands.start(command)
+        result = self._local_result(command, params)
+        cache_key = self._cache_key(command, params)
+        if result is None and cache_key is not None:
+            result = self._cache.get(cache_key)
+        if result is not None:
+            socket_handler.queue_response({
+                "id": request["id"],
+                "error": None,
+                "result": result
+            })
+            timer.finish()
+            return True
+        inflight_key = self._inflight_key(command, params)
+        if inflight_key is not None and inflight_key in self._inflight:
+            self._inflight[inflight_key].add_waiter(
+                socket_handler, request["id"], timer)
+            self.coalesced += 1
+            return True
         # Create callback handler to write response to the socket.
-        handler = self.handlers[command](socket_handler, request["id"], self._client, self._legacy_server)
+        handler = self.handlers[command](socket_handler, request["id"], self._client, self._legacy_server, self)
         try:
             params = handler.translate_arguments(params)
         except Exception as exc:
             logging.error("Bad parameters specified: %s", exc, exc_info=True)
+            socket_handler.queue_response({
+                "id": request["id"],
+                "error": "Bad parameters specified",
+                "result": None
+            })
+            timer.finish("Bad parameters specified")
             return True
+        handler.set_timer(timer)
+        if cache_key is not None:
+            handler.set_cache(self._cache, cache_key)
+        if inflight_key is not None:
+            handler.set_inflight(self._inflight, inflight_key)
+        # Every command gets a single reply, give up on it after the
+        # deadline.
+        handler.set_deadline(
+            self._timeouts.get(command, self._default_timeout),
+            partial(self._on_timeout, command))
         handler.call_client_method(request["command"], params)
         return True
 
@@ -0,0 +1,179 @@
+import logging
+import threading
+from collections import deque
+
+import config
+from encoding import PreEncoded
+
+MAX_BUFFER_BYTES = 4 * 1024 * 1024
+MAX_QUEUED_MESSAGES = 1000
+OVERFLOW_POLICIES = ("drop-oldest", "pause", "disconnect")
+
+def is_notification(response):
+    # Replies carry the id of their request, pushed updates don't.
+    return isinstance(response, PreEncoded) or "id" not in response
+
+class OutboxTotals(object):
+
+    def __init__(self):
+        self.dropped = 0
+        self.pauses = 0
+        self.disconnects = 0
+
+totals = OutboxTotals()
+
+class Outbox(object):
+    """Outbound queue of one websocket connection.
+
+    Responses are queued from any thread and written on the IOLoop once
+    per loop iteration. Frames handed to tornado count as buffered until
+    it reports them flushed to the socket, and nothing more is written
+    while the buffer is over max_bytes, so a slow reader makes the queue
+    grow instead. Once the queue holds more than max_messages responses
+    the overflow policy kicks in:
+
+    drop-oldest: the oldest queued notification is dropped.
+    pause: queued and new notifications are dropped until the client
+        has caught up, then it gets a "resume" notice with the number it
+        missed so it can refetch.
+    disconnect: the connection is closed.
+
+    Replies to requests are never dropped; when only replies are left
+    to drop the connection is closed.
+    """
+
+    def __init__(self, io_loop, send, close):
+        self._io_loop = io_loop
+        # send(response) -> (future or None, frame size)
+        self._send = send
+        self._close = close
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+        # (future, size) of frames tornado has not flushed yet.
+        self._writes = deque()
+        self.buffered_bytes = 0
+        self.max_bytes = config.get("websocket-max-buffer-bytes",
+                                    MAX_BUFFER_BYTES)
+        self.max_messages = config.get("websocket-max-queued-messages",
+                                       MAX_QUEUED_MESSAGES)
+        self.policy = config.get("websocket-overflow-policy", "drop-oldest")
+        if self.policy not in OVERFLOW_POLICIES:
+            self.policy = "drop-oldest"
+        self.paused = False
+        self.dropped = 0
+        # Notifications dropped since the last resume notice.
+        self._missed = 0
+        self.closed = False
+
+    def put(self, response):
+        with self._lock:
+            if self.closed:
+                return
+            if self.paused and is_notification(response):
+                self._drop(1)
+                return
+            self._queue.append(response)
+            if len(self._queue) > self.max_messages:
+                self._overflow()
+            if self._flush_scheduled or self.closed:
+                return
+            self._flush_scheduled = True
+        self._io_loop.add_callback(self.flush)
+
+    def close(self):
+        # Also called by send once the socket turns out closed, which
+        # stops a flush in progress.
+        with self._lock:
+            self.closed = True
+            self._queue.clear()
+
+    def _drop(self, count):
+        self.dropped += count
+        self._missed += count
+        totals.dropped += count
+
+    def _overflow(self):
+        # Called with the lock held, from any thread.
+        if self.policy == "drop-oldest":
+            for i, response in enumerate(self._queue):
+                if is_notification(response):
+                    del self._queue[i]
+                    self._drop(1)
+                    return
+        elif self.policy == "pause":
+            if not self.paused:
+                self.paused = True
+                totals.pauses += 1
+            replies = deque(response for response in self._queue
+                            if not is_notification(response))
+            self._drop(len(self._queue) - len(replies))
+            self._queue = replies
+            if len(self._queue) <= self.max_messages:
+                return
+        logging.warning("Disconnecting slow client, %s responses queued",
+                        len(self._queue))
+        totals.disconnects += 1
+        self.closed = True
+        self._queue.clear()
+        self._io_loop.add_callback(self._close)
+
+    def flush(self):
+        while True:
+            with self._lock:
+                if self.closed:
+                    self._flush_scheduled = False
+                    return
+                if not self._queue:
+                    self._flush_scheduled = False
+                    break
+                if self.buffered_bytes >= self.max_bytes:
+                    # Left scheduled, _on_written resumes once tornado
+                    # catches up.
+                    return
+                response = self._queue.popleft()
+            self._track(*self._send(response))
+        self._maybe_resume()
+
+    def _maybe_resume(self):
+        with self._lock:
+            if not self.paused or self.buffered_bytes > self.max_bytes / 2:
+                return
+            self.paused = False
+            missed = self._missed
+            self._missed = 0
+        self._track(*self._send({"type": "resume", "missed": missed}))
+
+    def _track(self, future, size):
+        # Older tornado versions don't return a future, frames then
+        # count as flushed right away.
+        if future is None:
+            return
+        self.buffered_bytes += size
+        self._writes.append((future, size))
+        future.add_done_callback(self._on_written)
+
+    def _on_written(self, future):
+        if not any(write[0] is future for write in self._writes):
+            return
+        # The stream flushes in order, so every earlier frame is out too.
+        while self._writes:
+            write_future, size = self._writes.popleft()
+            self.buffered_bytes -= size
+            if write_future is future:
+                break
+        if self.buffered_bytes < self.max_bytes and \
+                (self._flush_scheduled or self.paused):
+            self.flush()
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            'buffered_bytes': self.buffered_bytes,
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'paused': self.paused
+        }
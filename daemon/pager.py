@@ -0,0 +1,142 @@
+from twisted.internet import reactor
+
+import time
+import logging
+
+import cache
+import config
+from encoding import Binary
+from history_cache import history_size
+
+HISTORY_SNAPSHOT_SIZE = 16 * 1024 * 1024
+# Seconds a paginated history is kept around for follow-up pages.
+HISTORY_SNAPSHOT_TTL = 60
+
+# History rows are paged in a fixed order: confirmed rows by height, then
+# unconfirmed ones, ties broken by outpoint. A cursor names the last row
+# sent as "height:tx_hash:index", so rows arriving or confirming between
+# two requests don't shift the rows after it.
+
+def row_key(row):
+    o_hash, o_index, o_height = row[:3]
+    return (o_height == 0, o_height, o_hash, o_index)
+
+def sort_rows(rows):
+    return sorted(rows, key=row_key)
+
+def format_cursor(row):
+    o_hash, o_index, o_height = row[:3]
+    return "%d:%s:%d" % (o_height, o_hash.hex, o_index)
+
+def parse_cursor(cursor):
+    """Returns the row key a cursor stands for, raises ValueError if it is
+    malformed."""
+    parts = str(cursor).split(":")
+    if len(parts) != 3:
+        raise ValueError("Invalid cursor")
+    height, o_hash, o_index = int(parts[0]), parts[1].decode("hex"), \
+        int(parts[2])
+    if height < 0 or o_index < 0 or len(o_hash) != 32:
+        raise ValueError("Invalid cursor")
+    return (height == 0, height, Binary(o_hash), o_index)
+
+def find_after(rows, key):
+    # Index of the first row of the sorted rows past key.
+    low, high = 0, len(rows)
+    while low < high:
+        middle = (low + high) // 2
+        if row_key(rows[middle]) <= key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+class HistorySnapshots(object):
+    """Sorted histories of addresses being paged through.
+
+    The first page of a paginated fetch_history leaves the whole history
+    here, so following pages are cut from memory instead of fetching it
+    all again.
+    """
+
+    def __init__(self):
+        self._snapshots = cache.create_cache("history-snapshot-size",
+                                             HISTORY_SNAPSHOT_SIZE)
+        self._ttl = config.get("history-snapshot-ttl", HISTORY_SNAPSHOT_TTL)
+
+    def get(self, address, from_height):
+        entry = self._snapshots.get((address, from_height))
+        if entry is None:
+            return None
+        created, rows = entry
+        if time.time() - created > self._ttl:
+            self._snapshots.discard((address, from_height))
+            return None
+        return rows
+
+    def put(self, address, from_height, rows):
+        self._snapshots.put((address, from_height), (time.time(), rows),
+                            history_size(rows))
+
+    def clear(self):
+        self._snapshots.clear()
+
+    def stats(self):
+        return self._snapshots.stats()
+
+class Pager(object):
+    """Streams a long result list as a sequence of bounded frames.
+
+    One page is queued per reactor iteration so a huge result never gets
+    encoded as a single frame or stalls the loop. Rows must be sorted
+    with sort_rows. Every frame carries the cursor of its last row, or
+    None once the list is exhausted, so clients can pick up from there
+    later.
+    """
+
+    def __init__(self, waiters, rows, page_size, cursor=None, max_pages=0):
+        # waiters are (socket handler, request id, timer) tuples
+        self._waiters = waiters
+        self._rows = rows
+        self._page_size = page_size
+        self._index = 0
+        if cursor is not None:
+            self._index = find_after(rows, cursor)
+        self._pages_left = max_pages or -1
+
+    def start(self):
+        self._send_page()
+
+    def _send_page(self):
+        start = self._index
+        page = self._rows[start:start + self._page_size]
+        self._index = start + len(page)
+        self._pages_left -= 1
+        cursor = None
+        if self._index < len(self._rows):
+            cursor = format_cursor(page[-1])
+        more = cursor is not None and self._pages_left != 0
+        waiters = []
+        for handler, request_id, timer in self._waiters:
+            if not getattr(handler, "_connected", True):
+                if timer is not None:
+                    timer.finish()
+                continue
+            try:
+                handler.queue_response({
+                    "id": request_id,
+                    "error": None,
+                    "result": [page],
+                    "cursor": cursor,
+                    "more": more
+                })
+            except:
+                logging.error("Error sending page", exc_info=True)
+                continue
+            if more:
+                waiters.append((handler, request_id, timer))
+            elif timer is not None:
+                timer.finish()
+        self._waiters = waiters
+        if more and waiters:
+            reactor.callLater(0, self._send_page)
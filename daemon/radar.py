@@ -7,18 +7,23 @@ import struct
 from collections import defaultdict
 from twisted.internet import reactor
 
+from bus import LeaderRelay
+
 def hash_transaction(raw_tx):
     return obelisk.Hash(raw_tx)[::-1]
 
 class Radar:
-    def __init__(self):
+    def __init__(self, bus=None):
         self._monitor_tx = {}
         self._monitor_lock = threading.Lock()
         self.last_status = time.time()
         self.radar_hosts = 0
         self.issues = 0
-        reactor.callInThread(self.status_loop)
-        reactor.callInThread(self.feedback_loop)
+        relay = LeaderRelay(bus)
+        self._relay_feedback = relay.topic("radar_feedback",
+                                           self.on_feedback_msg, binary=True)
+        self._relay_status = relay.topic("radar_status", self.on_status)
+        relay.run(self.status_loop, self.feedback_loop)
         reactor.callLater(1, self.watchdog)
 
     def watchdog(self):
@@ -43,10 +48,16 @@ class Radar:
             while socket.getsockopt(zmq.RCVMORE):
                 msg.append(socket.recv())
             if len(msg) == 2:
-                self.on_feedback_msg(*msg)
+                self._relay_feedback(*msg)
             else:
                 print "bad feedback message", len(msg)
 
+    def on_status(self, nodes):
+        self.last_status = time.time()
+        if not nodes == self.radar_hosts:
+            print "radar hosts", nodes
+            self.radar_hosts = nodes
+
     def on_feedback_msg(self, node_id_raw, tx_hash):
         try:
             node_id = struct.unpack("<I", node_id_raw)
@@ -67,15 +78,12 @@ class Radar:
         print "radar status channel connected"
         while True:
             msg = socket.recv()
-            nodes = 0
             try:
                 nodes = struct.unpack("<Q", msg)[0]
-                self.last_status = time.time()
             except:
                 print "bad nodes data", msg
-            if not nodes == self.radar_hosts:
-                print "radar hosts", nodes
-                self.radar_hosts = nodes
+                continue
+            self._relay_status(nodes)
 
     def _increment_monitored_tx(self, tx_hash):
         with self._monitor_lock:
@@ -0,0 +1,140 @@
+import time
+import weakref
+from collections import defaultdict
+
+import config
+import metrics
+
+# Tokens refilled per second and bucket size, in units of command cost.
+CONNECTION_RATE = 50
+CONNECTION_BURST = 500
+ADDRESS_RATE = 100
+ADDRESS_BURST = 1000
+# Seconds between sweeps of idle per address buckets.
+SWEEP_INTERVAL = 60
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def has(self, cost):
+        # A request costing more than the whole bucket goes through once
+        # the bucket is full and leaves it in debt.
+        return self.tokens >= min(cost, self.burst)
+
+    def take(self, cost):
+        self.tokens -= cost
+
+    @property
+    def full(self):
+        return self.tokens >= self.burst
+
+class RateLimiter(object):
+    """Cost weighted token buckets per connection and per remote address.
+
+    A request is admitted only if every bucket it is charged to has the
+    tokens for it, and is then charged to all of them.
+
+    Limits are configured for the whole gateway. When it runs as shares
+    worker processes the connections of one address are spread over all
+    of them, so each worker gets 1/shares of the rate and burst of an
+    address bucket. A connection stays in one worker and keeps its full
+    bucket.
+
+    It is off unless rate-limit is set. Remote addresses are only those
+    of the clients when the gateway sees them directly, or behind a proxy
+    with xheaders set, otherwise every client shares one address bucket.
+    """
+
+    def __init__(self, shares=1):
+        self.enabled = config.get("rate-limit", False)
+        self._connection_rate = config.get("rate-limit-connection-rate",
+                                           CONNECTION_RATE)
+        self._connection_burst = config.get("rate-limit-connection-burst",
+                                            CONNECTION_BURST)
+        self._address_rate = float(config.get("rate-limit-address-rate",
+                                              ADDRESS_RATE)) / shares
+        self._address_burst = float(config.get("rate-limit-address-burst",
+                                               ADDRESS_BURST)) / shares
+        self._exempt = set(config.get("rate-limit-exempt", []))
+        self._connections = weakref.WeakKeyDictionary()
+        self._addresses = {}
+        self._last_sweep = time.time()
+        self.admitted = 0
+        # (scope, command) -> requests refused
+        self.limited = defaultdict(int)
+        metrics.registry.register(self.collect_metrics)
+
+    def admit(self, command, cost, address, connection=None):
+        if not self.enabled or address in self._exempt:
+            return True
+        now = time.time()
+        buckets = [("address", self._address_bucket(address, now))]
+        if connection is not None:
+            buckets.append(
+                ("connection", self._connection_bucket(connection, now)))
+        for scope, bucket in buckets:
+            bucket.refill(now)
+            if not bucket.has(cost):
+                self.limited[(scope, command)] += 1
+                return False
+        for scope, bucket in buckets:
+            bucket.take(cost)
+        self.admitted += 1
+        if now - self._last_sweep > SWEEP_INTERVAL:
+            self._sweep(now)
+        return True
+
+    def _address_bucket(self, address, now):
+        bucket = self._addresses.get(address)
+        if bucket is None:
+            bucket = TokenBucket(self._address_rate, self._address_burst, now)
+            self._addresses[address] = bucket
+        return bucket
+
+    def _connection_bucket(self, connection, now):
+        bucket = self._connections.get(connection)
+        if bucket is None:
+            bucket = TokenBucket(self._connection_rate,
+                                 self._connection_burst, now)
+            self._connections[connection] = bucket
+        return bucket
+
+    def _sweep(self, now):
+        # A full bucket is the same as no bucket.
+        self._last_sweep = now
+        for address, bucket in self._addresses.items():
+            bucket.refill(now)
+            if bucket.full:
+                del self._addresses[address]
+
+    def stats(self):
+        limited = defaultdict(dict)
+        for (scope, command), count in self.limited.items():
+            limited[scope][command] = count
+        return {
+            'enabled': self.enabled,
+            'addresses': len(self._addresses),
+            'admitted': self.admitted,
+            'limited': dict(limited)
+        }
+
+    def collect_metrics(self):
+        Metric = metrics.Metric
+        admitted = Metric("gateway_rate_limit_admitted_total", "counter",
+                          "Requests admitted by the rate limiter")
+        admitted.add(self.admitted)
+        limited = Metric("gateway_rate_limited_total", "counter",
+                         "Requests refused for exceeding a rate limit")
+        for (scope, command), count in self.limited.items():
+            limited.add(count, scope=scope, command=command)
+        return [admitted, limited]
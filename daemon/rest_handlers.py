@@ -5,53 +5,97 @@ import random
 
 from tornado.web import asynchronous, HTTPError
 
+from encoding import JSON
+
 def random_id_number():
     return random.randint(0, 2**32 - 1)
 
+# HTTP status for errors the obelisk handler answers with, anything else
+# is a server error.
+ERROR_STATUS = {
+    "Bad parameters specified":     400,
+    "not_found":                    404,
+    "Server busy":                  503,
+    "timeout":                      504
+}
+
+def check_rate_limit(handler, request):
+    # REST clients only have a per address budget.
+    if not handler.application.admit_request(request,
+                                             handler.request.remote_ip):
+        raise HTTPError(429, reason="Rate limit exceeded")
+
 # Implements the on_fetch method for all HTTP requests.
 class BaseHTTPHandler(tornado.web.RequestHandler):
     def on_fetch(self, response):
         self.finish(json.dumps(response))
 
+class ObeliskHTTPHandler(tornado.web.RequestHandler):
+    """Serves a request through the obelisk handler, standing in for the
+    socket handler. The first result is sent back under result_key."""
+
+    result_key = "result"
+    _closed = False
+
+    @property
+    def _connected(self):
+        # Lets queued requests be dropped once the client hangs up.
+        return not self._closed and not self._finished
+
+    def on_connection_close(self):
+        self._closed = True
+
+    def fetch(self, command, params):
+        request = {
+            "id": random_id_number(),
+            "command": command,
+            "params": params
+        }
+        check_rate_limit(self, request)
+        self.application.obelisk_handler.handle_request(self, request)
+
+    def queue_response(self, response):
+        if self._finished:
+            return
+        if response["error"]:
+            self.send_error(ERROR_STATUS.get(response["error"], 500),
+                            reason=response["error"])
+            return
+        self.finish(JSON.dumps({self.result_key: response["result"][0]}))
+
+
+class BlockHeaderHandler(ObeliskHTTPHandler):
+
+    result_key = "header"
 
-class BlockHeaderHandler(tornado.web.RequestHandler):
     @asynchronous
     def get(self, blk_hash=None):
         if blk_hash is None:
             raise HTTPError(400, reason="No block hash")
 
         try:
-            blk_hash = blk_hash.decode("hex")
-        except ValueError:
+            blk_hash.decode("hex")
+        except (TypeError, ValueError):
             raise HTTPError(400, reason="Invalid hash")
 
-        request = {
-            "id": random_id_number(),
-            "command":"fetch_block_header",
-            "params": [blk_hash]
-        }
+        self.fetch("fetch_block_header", [blk_hash])
+
 
-        self.application._obelisk_handler.handle_request(self, request)
+class BlockTransactionsHandler(ObeliskHTTPHandler):
 
+    result_key = "transactions"
 
-class BlockTransactionsHandler(tornado.web.RequestHandler):
     @asynchronous
     def get(self, blk_hash=None):
         if blk_hash is None:
             raise HTTPError(400, reason="No block hash")
 
         try:
-            blk_hash = blk_hash.decode("hex")
-        except ValueError:
+            blk_hash.decode("hex")
+        except (TypeError, ValueError):
             raise HTTPError(400, reason="Invalid hash")
 
-        request = {
-            "id": random_id_number(),
-            "command":"fetch_block_transaction_hashes",
-            "params": [blk_hash]
-        }
-
-        self.application._obelisk_handler.handle_request(self, request)
+        self.fetch("fetch_block_transaction_hashes", [blk_hash])
 
 class TransactionPoolHandler(tornado.web.RequestHandler):
     @asynchronous
@@ -68,47 +112,54 @@ class TransactionPoolHandler(tornado.web.RequestHandler):
         raise NotImplementedError
 
 
-class TransactionHandler(tornado.web.RequestHandler):
+class TransactionHandler(ObeliskHTTPHandler):
+
+    result_key = "transaction"
+
     @asynchronous
     def get(self, tx_hash=None):
         if tx_hash is None:
-            raise HTTPError(400, reason="No block hash")
+            raise HTTPError(400, reason="No transaction hash")
 
         try:
-            tx_hash = tx_hash.decode("hex")
-        except ValueError:
+            tx_hash.decode("hex")
+        except (TypeError, ValueError):
             raise HTTPError(400, reason="Invalid hash")
 
-        request = {
-            "id": random_id_number(),
-            "command":"fetch_transaction",
-            "params": [tx_hash]
-        }
-
-        self.application._obelisk_handler.handle_request(self, request)
+        self.fetch("fetch_transaction", [tx_hash])
 
-class AddressHistoryHandler(tornado.web.RequestHandler):
+class AddressHistoryHandler(ObeliskHTTPHandler):
     @asynchronous
     def get(self, address=None):
         if address is None:
             raise HTTPError(400, reason="No address")
 
+        obelisk_handler = self.application.obelisk_handler
         try:
             from_height = long(self.get_argument("from_height", 0))
-        except:
-            raise HTTPError(400)
-
-        address_decoded = base58.b58decode(address)
-        address_version = address_decoded[0]
-        address_hash = address_decoded[1:21]
-
-        request = {
-            "id": random_id_number(),
-            "command":"fetch_history",
-            "params": [address_version, address_hash, from_height]
-        }
-
-        self.application._obelisk_handler.handle_request(self, request)
+            page_size = int(self.get_argument("page_size",
+                                              obelisk_handler.history_page_size))
+        except ValueError:
+            raise HTTPError(400, reason="Invalid parameters")
+        if from_height < 0 or page_size <= 0:
+            raise HTTPError(400, reason="Invalid parameters")
+        # Opaque, the obelisk handler rejects malformed ones.
+        cursor = self.get_argument("cursor", None)
+
+        # One page per request, follow the returned cursor for the rest.
+        self.fetch("fetch_history",
+                   [address, from_height, page_size, cursor, 1])
+
+    def queue_response(self, response):
+        if self._finished:
+            return
+        if response["error"]:
+            ObeliskHTTPHandler.queue_response(self, response)
+            return
+        self.finish(JSON.dumps({
+            "history": response["result"][0],
+            "cursor": response.get("cursor")
+        }))
 
 
 class BaseHTTPHandler(tornado.web.RequestHandler):
@@ -116,14 +167,16 @@ class BaseHTTPHandler(tornado.web.RequestHandler):
         self.finish(response)
 
 
-class HeightHandler(BaseHTTPHandler):
-    @asynchronous
-    def get(self):
-        request = {
-            "id": random_id_number(),
-            "command":"fetch_last_height",
-            "params": None
-        }
+class HeightHandler(ObeliskHTTPHandler):
 
-        self.application._obelisk_handler.handle_request(self, request)
+    result_key = "height"
 
+    @asynchronous
+    def get(self):
+        # The chain tracker follows the tip, only ask the backend before
+        # it has heard of one.
+        height = self.application.obelisk_handler.chain.height
+        if height is not None:
+            self.finish(json.dumps({"height": height}))
+            return
+        self.fetch("fetch_last_height", [])
@@ -0,0 +1,232 @@
+from twisted.internet import reactor
+
+import time
+import logging
+from collections import deque
+from functools import partial
+
+import config
+import metrics
+from backend_pool import BACKEND_TIMEOUT, POSITIONAL_CALLBACKS
+
+# Highest priority first. Queued calls of a class only start when no
+# class before it has one waiting.
+PRIORITY_CLASSES = ("interactive", "bulk")
+
+COMMAND_CLASSES = {
+    "fetch_last_height":                "interactive",
+    "fetch_transaction":                "interactive",
+    "fetch_block_header":               "interactive",
+    "fetch_spend":                      "interactive",
+    "fetch_transaction_index":          "interactive",
+    "fetch_block_height":               "interactive",
+    "fetch_history":                    "bulk",
+    "fetch_block_transaction_hashes":   "bulk",
+    "fetch_stealth":                    "bulk"
+}
+
+# Upstream requests in flight, over all classes and per class.
+MAX_INFLIGHT = 64
+CLASS_LIMITS = {
+    "interactive":  64,
+    "bulk":         16
+}
+# Calls allowed to wait per class before new ones are shed.
+CLASS_QUEUE_SIZES = {
+    "interactive":  1000,
+    "bulk":         500
+}
+
+class Overloaded(Exception):
+    def __str__(self):
+        return "Server busy"
+
+class PriorityClass(object):
+
+    def __init__(self, name, limit, queue_size):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.queue = deque()
+        self.started = 0
+        self.shed = 0
+        # Queued calls dropped for being cancelled while waiting.
+        self.cancelled = 0
+        self.wait = metrics.Histogram()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queued': len(self.queue),
+            'limit': self.limit,
+            'queue_size': self.queue_size,
+            'started': self.started,
+            'shed': self.shed,
+            'cancelled': self.cancelled,
+            'wait': self.wait.stats()
+        }
+
+class Scheduler(object):
+    """Stands in for the obelisk client and orders calls by priority.
+
+    Cheap lookups and bulk scans each have a cap on upstream requests in
+    flight, on top of a cap over all of them. Calls over the caps wait in
+    a bounded queue per class, and a full queue makes the call raise
+    Overloaded instead. Calls not listed in COMMAND_CLASSES, such as the
+    address subscriptions, go straight through.
+
+    Callbacks may tell they are no longer wanted through is_cancelled(),
+    queued calls whose callback is cancelled by the time a slot frees up
+    are dropped without going upstream.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._max_inflight = config.get("scheduler-max-inflight",
+                                        MAX_INFLIGHT)
+        limits = dict(CLASS_LIMITS)
+        limits.update(config.get("scheduler-class-limits", {}))
+        queue_sizes = dict(CLASS_QUEUE_SIZES)
+        queue_sizes.update(config.get("scheduler-queue-sizes", {}))
+        self._classes = dict((name, PriorityClass(name, limits[name],
+                                                  queue_sizes[name]))
+                             for name in PRIORITY_CLASSES)
+        self._ordered = [self._classes[name] for name in PRIORITY_CLASSES]
+        # A slot is given back when the reply comes in or after this long.
+        self._timeout = config.get("backend-timeout", BACKEND_TIMEOUT)
+        self.active = 0
+        metrics.registry.register(self.collect_metrics)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in COMMAND_CLASSES:
+            return getattr(self._client, name)
+        return partial(self._call, name)
+
+    def _call(self, method_name, *args, **kwargs):
+        priority_class = self._classes[COMMAND_CLASSES[method_name]]
+        call = (method_name, args, kwargs, time.time())
+        if self._can_start(priority_class) and not self._waiting_before(
+                priority_class):
+            self._start(priority_class, call)
+            return
+        if len(priority_class.queue) >= priority_class.queue_size:
+            priority_class.shed += 1
+            raise Overloaded()
+        priority_class.queue.append(call)
+
+    def _can_start(self, priority_class):
+        return self.active < self._max_inflight and \
+            priority_class.active < priority_class.limit
+
+    def _waiting_before(self, priority_class):
+        # Don't overtake calls of a higher class waiting for a slot.
+        for other in self._ordered:
+            if other is priority_class:
+                return False
+            if other.queue and other.active < other.limit:
+                return True
+        return False
+
+    def _start(self, priority_class, call):
+        method_name, args, kwargs, queued = call
+        self.active += 1
+        priority_class.active += 1
+        priority_class.started += 1
+        priority_class.wait.observe(time.time() - queued)
+        release = self._releaser(priority_class)
+        if "cb" in kwargs and kwargs["cb"] is not None:
+            kwargs["cb"] = self._wrap(kwargs["cb"], release)
+        elif method_name in POSITIONAL_CALLBACKS:
+            index = POSITIONAL_CALLBACKS[method_name]
+            args = list(args)
+            args[index] = self._wrap(args[index], release)
+        try:
+            getattr(self._client, method_name)(*args, **kwargs)
+        except:
+            logging.error("Error calling %s", method_name, exc_info=True)
+            release()
+
+    def _releaser(self, priority_class):
+        def on_timeout():
+            timeout[0] = None
+            release()
+        def release():
+            if released[0]:
+                return
+            released[0] = True
+            if timeout[0] is not None:
+                if timeout[0].active():
+                    timeout[0].cancel()
+                timeout[0] = None
+            self.active -= 1
+            priority_class.active -= 1
+            self._drain()
+        released = [False]
+        timeout = [reactor.callLater(self._timeout, on_timeout)]
+        return release
+
+    def _wrap(self, cb, release):
+        def wrapped_cb(*args):
+            release()
+            return cb(*args)
+        return wrapped_cb
+
+    def _callback(self, method_name, args, kwargs):
+        if kwargs.get("cb") is not None:
+            return kwargs["cb"]
+        if method_name in POSITIONAL_CALLBACKS:
+            return args[POSITIONAL_CALLBACKS[method_name]]
+        return None
+
+    def _cancelled(self, call):
+        method_name, args, kwargs, queued = call
+        callback = self._callback(method_name, args, kwargs)
+        is_cancelled = getattr(callback, "is_cancelled", None)
+        if is_cancelled is None or not is_cancelled():
+            return False
+        # The client was answered with a timeout or went away.
+        callback.cancel()
+        return True
+
+    def _drain(self):
+        for priority_class in self._ordered:
+            while priority_class.queue and self._can_start(priority_class):
+                call = priority_class.queue.popleft()
+                if self._cancelled(call):
+                    priority_class.cancelled += 1
+                    continue
+                self._start(priority_class, call)
+            if self.active >= self._max_inflight:
+                return
+
+    def stats(self):
+        stats = dict((priority_class.name, priority_class.stats())
+                     for priority_class in self._ordered)
+        stats['active'] = self.active
+        return stats
+
+    def collect_metrics(self):
+        Metric = metrics.Metric
+        active = Metric("gateway_scheduler_active", "gauge",
+                        "Upstream requests in flight per priority class")
+        queued = Metric("gateway_scheduler_queued", "gauge",
+                        "Calls waiting for a slot per priority class")
+        shed = Metric("gateway_scheduler_shed_total", "counter",
+                      "Calls refused for a full queue per priority class")
+        cancelled = Metric("gateway_scheduler_cancelled_total", "counter",
+                           "Queued calls dropped for being cancelled")
+        wait = Metric("gateway_scheduler_wait_seconds", "histogram",
+                      "Time calls waited for a slot per priority class")
+        for priority_class in self._ordered:
+            active.add(priority_class.active, priority=priority_class.name)
+            queued.add(len(priority_class.queue),
+                       priority=priority_class.name)
+            shed.add(priority_class.shed, priority=priority_class.name)
+            cancelled.add(priority_class.cancelled,
+                          priority=priority_class.name)
+            wait.add_histogram(priority_class.wait,
+                               priority=priority_class.name)
+        return [active, queued, shed, cancelled, wait]
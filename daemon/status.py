@@ -1,17 +1,59 @@
 import json
 import tornado.web
+from tornado.web import asynchronous
+from twisted.internet import threads
+
+import metrics
+import compression
 
 class StatusHandler(tornado.web.RequestHandler):
     def __init__(self, *args, **kwargs):
         tornado.web.RequestHandler.__init__(self, *args)
         self.app = kwargs['app']
     def get(self):
-        stats = {
-            'brc': { 'peers': self.app.brc_handler._brc.last_nodes, 'issues': self.app.brc_handler._brc.issues },
-            'radar': { 'peers': self.app.brc_handler._radar.radar_hosts, 'issues': self.app.brc_handler._radar.issues },
-            'ticker': {'issues': self.app.ticker_handler._ticker.issues, 'price': self.app.ticker_handler._ticker.ticker.get('EUR', {}).get('24h_avg', 'error')},
-            'p2p': {'peers': len(self.app.p2p._peers.keys())}
-        }
+        stats = self.app.brc_handler.stats()
+        stats.update({
+            'ticker': self.app.ticker_handler.stats(),
+            'cache': self.app.obelisk_handler.cache_stats(),
+            'inflight': self.app.obelisk_handler.inflight_stats(),
+            'subscriptions': self.app.obelisk_handler.subscriptions.stats(),
+            'history_cache': self.app.obelisk_handler.history_cache.stats(),
+            'history_snapshots':
+                self.app.obelisk_handler.history_snapshots.stats(),
+            'chain': self.app.obelisk_handler.chain.stats(),
+            'stealth_index': self.app.obelisk_handler.stealth_index.stats(),
+            'scheduler': self.app.obelisk_handler.scheduler.stats(),
+            'blocks': self.app.obelisk_handler.block_subscriptions.stats(),
+            'commands': metrics.commands.stats(),
+            'dispatch': self.app.commands.stats(),
+            'rate_limits': self.app.rate_limiter.stats(),
+            'encode': metrics.encode.stats(),
+            'compression': compression.totals.stats(),
+            'connections': self.app.connection_stats()
+        })
+        if self.app.backend_pool:
+            stats['backends'] = self.app.backend_pool.stats()
+        if self.app.p2p is not None:
+            stats['p2p'] = {'peers': self.app.p2p.peer_count}
+        if self.app.bus is not None:
+            stats['bus'] = self.app.bus.stats()
         self.write(json.dumps(stats))
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves the metrics registry in Prometheus text format."""
+
+    @asynchronous
+    def get(self):
+        # Collecting only copies numbers, the text is rendered in a
+        # thread so large scrapes don't hold up the event loop.
+        collected = metrics.registry.collect()
+        deferred = threads.deferToThread(metrics.render, collected)
+        deferred.addCallbacks(self.on_rendered, self.on_error)
+
+    def on_rendered(self, text):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(text)
 
+    def on_error(self, failure):
+        failure.printTraceback()
+        self.send_error(500)
@@ -0,0 +1,112 @@
+from bisect import bisect_right, insort
+
+import cache
+import config
+
+STEALTH_CACHE_SIZE = 32 * 1024 * 1024
+# Blocks below the tip a segment stops at. The backend answering a scan
+# may lag behind the tip the gateway knows, so the last few blocks are
+# always scanned again.
+SAFETY_MARGIN = 10
+# Blocks a segment may start before the requested height and still be
+# used for it.
+REUSE_SPAN = 1000
+
+class StealthIndex(object):
+    """Translated fetch_stealth2 rows indexed by prefix and block range.
+
+    Stealth rows carry no height, so a scan can't be cut at an arbitrary
+    height. Instead every upstream scan is stored as a segment running from
+    its start height up to a safety margin below the tip at the time of
+    the scan. A later scan from any height inside a segment walks the
+    chain of segments and only the tail after the last one has to come
+    from the backend, which then becomes the next segment of the chain.
+    Rows of a segment starting before the requested height are served
+    too, like the extra rows a prefix match brings.
+    """
+
+    def __init__(self):
+        # (prefix, start) -> (end, rows)
+        self._segments = cache.create_cache("stealth-cache-size",
+                                            STEALTH_CACHE_SIZE)
+        # prefix -> sorted segment starts, may name evicted segments.
+        self._starts = {}
+        self._margin = config.get("stealth-index-margin", SAFETY_MARGIN)
+        self._reuse_span = config.get("stealth-index-reuse-span",
+                                      REUSE_SPAN)
+
+    def lookup(self, prefix, from_height, tip):
+        """Returns the locally known rows and the height the backend scan
+        has to start from, or None if the range up to tip is covered."""
+        prefix = tuple(prefix)
+        rows = []
+        height = from_height
+        lowest = from_height - self._reuse_span
+        while True:
+            segment = self._covering(prefix, height, lowest)
+            if segment is None:
+                break
+            end, segment_rows = segment
+            rows = merge_rows(rows, segment_rows)
+            # Later segments only have to join up with this one.
+            lowest = height
+            height = end + 1
+        # Only segments can say there is nothing left to scan, the tip
+        # known here may be behind the backend.
+        if height > from_height and tip is not None and height > tip:
+            return rows, None
+        return rows, height
+
+    def _covering(self, prefix, height, lowest):
+        # The segment reaching furthest among those holding height and
+        # starting no lower than lowest.
+        starts = self._starts.get(prefix)
+        if not starts:
+            return None
+        best = None
+        i = bisect_right(starts, height)
+        while i > 0 and starts[i - 1] >= lowest:
+            i -= 1
+            segment = self._segments.get((prefix, starts[i]))
+            if segment is None:
+                # Evicted from the cache.
+                del starts[i]
+                continue
+            if segment[0] >= height and \
+                    (best is None or segment[0] > best[0]):
+                best = segment
+        if not starts:
+            del self._starts[prefix]
+        return best
+
+    def store(self, prefix, start, tip, rows):
+        if tip is None:
+            return
+        end = tip - self._margin
+        if end < start:
+            return
+        prefix = tuple(prefix)
+        current = self._segments.peek((prefix, start))
+        if current is not None and current[0] >= end:
+            return
+        self._segments.put((prefix, start), (end, rows))
+        starts = self._starts.setdefault(prefix, [])
+        if current is None and start not in starts:
+            insort(starts, start)
+
+    def clear(self):
+        self._segments.clear()
+        self._starts.clear()
+
+    def stats(self):
+        return self._segments.stats()
+
+def merge_rows(rows, tail_rows):
+    # Scans overlap, at least by the safety margin, so the next segment
+    # can repeat a few rows.
+    seen = set((row[0], row[2]) for row in rows)
+    merged = list(rows)
+    for row in tail_rows:
+        if (row[0], row[2]) not in seen:
+            merged.append(row)
+    return merged
@@ -0,0 +1,353 @@
+import time
+import logging
+import obelisk
+
+import config
+from encoding import Binary, PreEncoded
+from timing_wheel import TimingWheel
+
+RENEW_INTERVAL = 120
+RENEW_SLOTS = 120
+
+class AddressSubscription(object):
+
+    def __init__(self, address):
+        self.address = address
+        # Local sockets watching this address.
+        self.subscribers = set()
+        # Replies waiting for the upstream subscription to be confirmed.
+        self.pending = []
+        self.subscribed = False
+        self.result = None
+        # Whether this process holds the upstream subscription itself.
+        self.upstream = False
+
+class AddressSubscriptions(object):
+    """Multiplexes local address subscriptions over a single upstream
+    subscription per address.
+
+    With a bus every address is owned by one process, the only one
+    holding its upstream subscription. The others announce their interest
+    to the owner, again on every renewal, and get the updates relayed
+    over the bus. When a process goes away or comes back the upstream
+    subscriptions of the addresses changing owner move with them.
+    """
+
+    def __init__(self, client, history_cache=None, bus=None):
+        self._client = client
+        self._history_cache = history_cache
+        self._addresses = {}
+        self._renew_interval = config.get("renew-interval", RENEW_INTERVAL)
+        self._renewals = TimingWheel(
+            self._renew_interval,
+            config.get("renew-slots", RENEW_SLOTS),
+            self._renew)
+        self.updates = 0
+        self._bus = bus
+        # address -> {node: last announcement} of remote interest in the
+        # addresses owned here.
+        self._remote = {}
+        if bus is not None:
+            bus.subscribe("address_interest", self._on_interest)
+            bus.subscribe("address_subscribed", self._on_remote_subscribed)
+            bus.subscribe("address_update", self._on_remote_update)
+            bus.add_membership_listener(self._on_membership)
+
+    def _is_owner(self, address):
+        return self._bus is None or self._bus.is_owner(address)
+
+    def subscribe(self, address, socket_handler, reply):
+        subscription = self._addresses.get(address)
+        new = subscription is None
+        if new:
+            subscription = AddressSubscription(address)
+            self._addresses[address] = subscription
+        subscription.subscribers.add(socket_handler)
+        socket_handler._subscriptions['obelisk'][address] = subscription
+        if subscription.subscribed:
+            reply(None, subscription.result)
+            return
+        subscription.pending.append(reply)
+        if not new:
+            return
+        if self._is_owner(address):
+            self._subscribe_upstream(subscription)
+        else:
+            self._renewals.add(address)
+            self._bus.publish("address_interest", address, True)
+
+    def _subscribe_upstream(self, subscription):
+        subscription.upstream = True
+        def on_subscribed(error, data=None):
+            self._on_subscribed(subscription, error, data)
+        self._client.subscribe_address(subscription.address,
+                                       self.callback_update,
+                                       cb=on_subscribed)
+
+    def unsubscribe(self, address, socket_handler, reply=None):
+        socket_handler._subscriptions['obelisk'].pop(address, None)
+        subscription = self._addresses.get(address)
+        if subscription is None or \
+                socket_handler not in subscription.subscribers:
+            if reply:
+                reply(None, False)
+            return
+        subscription.subscribers.discard(socket_handler)
+        if subscription.subscribers:
+            if reply:
+                reply(None, True)
+            return
+        if not subscription.upstream:
+            self._drop(subscription)
+            self._bus.publish("address_interest", address, False)
+            if reply:
+                reply(None, True)
+            return
+        if self._remote.get(address):
+            # Other processes still need the upstream subscription.
+            if reply:
+                reply(None, True)
+            return
+        # Last local subscriber left, drop the upstream subscription.
+        self._drop(subscription)
+        self._client.unsubscribe_address(address, self.callback_update,
+                                         cb=reply)
+
+    def is_upstream(self, address):
+        # Only updates straight from the backend are known to arrive in
+        # full, those relayed over the bus may get lost.
+        subscription = self._addresses.get(address)
+        return subscription is not None and subscription.subscribed and \
+            subscription.upstream
+
+    def forget_reply(self, address, reply):
+        # The reply gave up waiting for the upstream subscription.
+        subscription = self._addresses.get(address)
+        if subscription is not None and reply in subscription.pending:
+            subscription.pending.remove(reply)
+
+    def on_backend_moved(self, addresses):
+        # Updates sent while the old backend was failing are lost.
+        if self._history_cache:
+            for address in addresses:
+                self._history_cache.discard(address)
+
+    def unsubscribe_all(self, socket_handler):
+        for address in list(socket_handler._subscriptions['obelisk']):
+            try:
+                self.unsubscribe(address, socket_handler)
+            except:
+                logging.error("Error unsubscribing %s", address,
+                              exc_info=True)
+
+    def _drop(self, subscription):
+        if self._addresses.get(subscription.address) is subscription:
+            del self._addresses[subscription.address]
+            self._renewals.remove(subscription.address)
+            if self._history_cache:
+                self._history_cache.discard(subscription.address)
+
+    def _on_subscribed(self, subscription, error, data):
+        pending = subscription.pending
+        subscription.pending = []
+        if error:
+            logging.error("Error subscribing %s: %s",
+                          subscription.address, error)
+            for socket_handler in subscription.subscribers:
+                socket_handler._subscriptions['obelisk'].pop(
+                    subscription.address, None)
+            self._drop(subscription)
+            # Interested processes have been told and drop theirs.
+            self._remote.pop(subscription.address, None)
+        else:
+            subscription.subscribed = True
+            subscription.result = data
+            # Everybody may have left while waiting for confirmation.
+            if self._addresses.get(subscription.address) is subscription:
+                self._renewals.add(subscription.address)
+        if self._bus is not None and self._is_owner(subscription.address):
+            self._bus.publish("address_subscribed", subscription.address,
+                              error)
+        for reply in pending:
+            reply(error, data)
+
+    def _renew(self, address):
+        subscription = self._addresses.get(address)
+        if subscription is None:
+            return
+        if not subscription.upstream:
+            self._bus.publish("address_interest", address, True)
+            return
+        remote = self._remote.get(address)
+        if remote:
+            # Interest not announced for a few rounds is from a process
+            # that went away.
+            expired = time.time() - 3 * self._renew_interval
+            for node, announced in remote.items():
+                if announced < expired:
+                    del remote[node]
+            if not remote:
+                del self._remote[address]
+        if not subscription.subscribers and address not in self._remote:
+            self._drop(subscription)
+            self._client.unsubscribe_address(address, self.callback_update,
+                                             cb=None)
+            return
+        self._client.renew_address(address, cb=self._on_renewed)
+
+    def _on_interest(self, node, address, interested):
+        if not self._is_owner(address):
+            return
+        if not interested:
+            remote = self._remote.get(address, {})
+            remote.pop(node, None)
+            if remote:
+                return
+            self._remote.pop(address, None)
+            subscription = self._addresses.get(address)
+            if subscription is not None and not subscription.subscribers:
+                self._drop(subscription)
+                self._client.unsubscribe_address(
+                    address, self.callback_update, cb=None)
+            return
+        self._remote.setdefault(address, {})[node] = time.time()
+        subscription = self._addresses.get(address)
+        if subscription is None:
+            subscription = AddressSubscription(address)
+            self._addresses[address] = subscription
+            self._subscribe_upstream(subscription)
+        elif subscription.subscribed:
+            self._bus.publish("address_subscribed", address, None)
+
+    def _on_remote_subscribed(self, node, address, error):
+        subscription = self._addresses.get(address)
+        if subscription is None or subscription.subscribed or \
+                subscription.upstream:
+            return
+        self._on_subscribed(subscription, error, None)
+
+    def _on_membership(self, live):
+        for address, subscription in self._addresses.items():
+            owner = self._is_owner(address)
+            if owner == subscription.upstream:
+                if not owner:
+                    # The owner may be new and not know about us yet.
+                    self._bus.publish("address_interest", address, True)
+                continue
+            # Updates may get lost while the subscription moves.
+            if self._history_cache:
+                self._history_cache.discard(address)
+            if owner:
+                self._subscribe_upstream(subscription)
+                continue
+            subscription.upstream = False
+            self._client.unsubscribe_address(address, self.callback_update,
+                                             cb=None)
+            if subscription.subscribers:
+                self._bus.publish("address_interest", address, True)
+            else:
+                self._drop(subscription)
+        for address in list(self._remote):
+            if not self._is_owner(address):
+                del self._remote[address]
+
+    def _on_remote_update(self, node, address, height, block_hash, tx):
+        subscription = self._addresses.get(address)
+        if subscription is None or subscription.upstream:
+            return
+        self._apply_update(address, height, block_hash.decode("hex"),
+                           tx.decode("hex"))
+
+    def _on_renewed(self, error, *args):
+        if error:
+            logging.error("Error renewing subscription: %s", error)
+
+    def callback_update(self, address_version, address_hash,
+                        height, block_hash, tx):
+        address = obelisk.bitcoin.hash_160_to_bc_address(
+            address_hash, address_version)
+        if self._remote.get(address):
+            self._bus.publish("address_update", address, height,
+                              block_hash.encode("hex"), tx.encode("hex"))
+        self._apply_update(address, height, block_hash, tx)
+
+    def _apply_update(self, address, height, block_hash, tx):
+        subscription = self._addresses.get(address)
+        if subscription is None:
+            return
+        self.updates += 1
+        if self._history_cache:
+            if subscription.upstream:
+                self._history_cache.apply_update(address, height, tx)
+            else:
+                self._history_cache.discard(address)
+        # Translated and serialized once for every subscriber.
+        response = PreEncoded({
+            "type": "update",
+            "address": address,
+            "height": height,
+            "block_hash": Binary(block_hash),
+            "tx": Binary(tx)
+        })
+        for socket_handler in list(subscription.subscribers):
+            if not socket_handler._connected:
+                continue
+            try:
+                socket_handler.queue_response(response)
+            except:
+                logging.error("Error sending message", exc_info=True)
+
+    def stats(self):
+        return {
+            'addresses': len(self._addresses),
+            'subscribers': sum(len(subscription.subscribers)
+                               for subscription in self._addresses.values()),
+            'updates': self.updates,
+            'remote': len(self._remote),
+            'renewals': self._renewals.stats()
+        }
+
+class BlockSubscriptions(object):
+    """Pushes every new chain tip to subscribed sockets, fed by the single
+    block source of the chain tracker."""
+
+    def __init__(self, chain_tracker):
+        self._chain = chain_tracker
+        self._subscribers = set()
+        self.notifications = 0
+        chain_tracker.add_block_listener(self.on_block)
+
+    def subscribe(self, socket_handler):
+        self._subscribers.add(socket_handler)
+
+    def unsubscribe(self, socket_handler):
+        if socket_handler not in self._subscribers:
+            return False
+        self._subscribers.discard(socket_handler)
+        return True
+
+    def on_block(self, height, block_hash, header):
+        # Headers backfilled below the tip are not news.
+        if height != self._chain.height or not self._subscribers:
+            return
+        self.notifications += 1
+        response = PreEncoded({
+            "type": "block",
+            "height": height,
+            "hash": block_hash,
+            "header": Binary(header)
+        })
+        for socket_handler in list(self._subscribers):
+            if not socket_handler._connected:
+                self._subscribers.discard(socket_handler)
+                continue
+            try:
+                socket_handler.queue_response(response)
+            except:
+                logging.error("Error sending message", exc_info=True)
+
+    def stats(self):
+        return {
+            'subscribers': len(self._subscribers),
+            'notifications': self.notifications
+        }
@@ -0,0 +1,62 @@
+import logging
+from collections import deque
+
+class ConcurrencyLimiter(object):
+    """Runs at most `limit` tasks at a time, queueing the rest.
+
+    A task is a callable started with a release function; it must call it
+    once its work is over so the next queued task can start. Calling it
+    again has no effect. Tasks often finish right away, so the queue is
+    drained in a loop rather than from inside release.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        # Queued tasks dropped for being cancelled while waiting.
+        self.dropped = 0
+        self._queue = deque()
+        self._draining = False
+
+    def submit(self, task, cancelled=None):
+        # cancelled(), if given, tells whether a task still waiting is
+        # no longer wanted.
+        self._queue.append((task, cancelled))
+        self._drain()
+
+    def _drain(self):
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self._queue and self.active < self.limit:
+                task, cancelled = self._queue.popleft()
+                if cancelled is not None and cancelled():
+                    self.dropped += 1
+                    continue
+                self.active += 1
+                self._run(task)
+        finally:
+            self._draining = False
+
+    def _release_once(self):
+        released = [False]
+        def release():
+            if released[0]:
+                return
+            released[0] = True
+            self.active -= 1
+            self._drain()
+        return release
+
+    def _run(self, task):
+        release = self._release_once()
+        try:
+            task(release)
+        except:
+            logging.error("Error running task", exc_info=True)
+            release()
+
+    @property
+    def queued(self):
+        return len(self._queue)
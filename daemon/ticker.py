@@ -1,32 +1,60 @@
+import logging
 import threading
 import urllib2
 import json
 import time
 
+import metrics
+
 class Ticker(threading.Thread):
 
     daemon = True
 
-    def __init__(self):
+    def __init__(self, bus=None):
         super(Ticker, self).__init__()
         self.lock = threading.Lock()
         self.ticker = {}
-        self.start()
         self.issues = 0
+        # Only the leader pulls prices and relays them to the others.
+        self._bus = bus
+        if bus is None:
+            self.start()
+            return
+        bus.subscribe("ticker", self.on_bus_ticker)
+        bus.add_leader_listener(self.start_once)
+
+    def start_once(self):
+        if self.ident is None:
+            self.start()
+
+    def leading(self):
+        return self._bus is None or self._bus.is_leader()
 
     def run(self):
         while True:
-            self.pull_prices()
+            if self.leading():
+                self.pull_prices()
             time.sleep(5 * 60)
 
     def pull_prices(self):
         ticker_all = self.query_ticker()
+        if self._bus is not None:
+            self._bus.publish("ticker", ticker_all or {}, self.issues)
         if not ticker_all:
             return
+        self.update(ticker_all)
+
+    def update(self, ticker_all):
         with self.lock:
             for currency, ticker_values in ticker_all.iteritems():
                 self.ticker[currency] = ticker_values
 
+    def on_bus_ticker(self, node, ticker_all, issues):
+        if self.leading():
+            return
+        self.issues = issues
+        self.update(ticker_all)
+
     def query_ticker(self):
         url = "https://api.bitcoinaverage.com/ticker/global/all"
         try:
@@ -49,14 +77,29 @@ class Ticker(threading.Thread):
 
 class TickerHandler:
 
-    def __init__(self):
-        self._ticker = Ticker()
+    def __init__(self, bus=None):
+        self._ticker = Ticker(bus)
+
+    def register(self, commands):
+        commands.register("fetch_ticker", self.handle_request)
+
+    def stats(self):
+        price = self._ticker.fetch('EUR') or {}
+        return {'issues': self._ticker.issues,
+                'price': price.get('24h_avg', 'error')}
 
     def handle_request(self, socket_handler, request):
         if request["command"] != "fetch_ticker":
             return False
+        timer = metrics.commands.start("fetch_ticker")
         if not request["params"]:
             logging.error("No param for ticker specified.")
+            socket_handler.queue_response({
+                "id": request["id"],
+                "error": "No param for ticker specified.",
+                "result": None
+            })
+            timer.finish("No param for ticker specified.")
             return True
         currency = request["params"][0]
         ticker_value = self._ticker.fetch(currency)
@@ -66,5 +109,6 @@ class TickerHandler:
             "result": [ticker_value]
         }
         socket_handler.queue_response(response)
+        timer.finish()
         return True
 
@@ -0,0 +1,76 @@
+from twisted.internet import reactor
+
+import logging
+
+class TimingWheel(object):
+    """Hashed timing wheel firing a callback for every key once per interval.
+
+    Keys are hashed into one of `slots` buckets and the wheel advances one
+    bucket every interval / slots seconds, so periodic work is spread evenly
+    instead of each key running its own reactor timer.
+    """
+
+    def __init__(self, interval, slots, callback):
+        self.interval = interval
+        self.slots = slots
+        self.tick = float(interval) / slots
+        self._callback = callback
+        self._buckets = [set() for i in xrange(slots)]
+        # Number of keys fired from each bucket on its last turn.
+        self._fired = [0] * slots
+        self._positions = {}
+        self._cursor = 0
+        self._task = None
+        self.total_fired = 0
+
+    def add(self, key):
+        if key in self._positions:
+            return
+        slot = hash(key) % self.slots
+        self._buckets[slot].add(key)
+        self._positions[key] = slot
+        if self._task is None:
+            self._task = reactor.callLater(self.tick, self._advance)
+
+    def remove(self, key):
+        slot = self._positions.pop(key, None)
+        if slot is not None:
+            self._buckets[slot].discard(key)
+        if not self._positions and self._task is not None:
+            if self._task.active():
+                self._task.cancel()
+            self._task = None
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _advance(self):
+        self._task = None
+        self._cursor = (self._cursor + 1) % self.slots
+        bucket = list(self._buckets[self._cursor])
+        for key in bucket:
+            try:
+                self._callback(key)
+            except:
+                logging.error("Error running timer for %s", key,
+                              exc_info=True)
+        self._fired[self._cursor] = len(bucket)
+        self.total_fired += len(bucket)
+        if self._positions:
+            self._task = reactor.callLater(self.tick, self._advance)
+
+    @property
+    def rate(self):
+        # Keys fired per second over the last full turn of the wheel.
+        return sum(self._fired) / float(self.interval)
+
+    def stats(self):
+        return {
+            'depth': len(self._positions),
+            'slots': self.slots,
+            'rate': self.rate,
+            'fired': self.total_fired
+        }
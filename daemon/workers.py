@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import subprocess
+
+import zmq
+
+import config
+from bus import Bus
+
+BUS_URL = "ipc:///tmp/darkwallet-gateway-%d"
+# Offset from the websocket port of the /status and /metrics port of the
+# first worker, the others follow it.
+STATUS_PORT_OFFSET = 100
+
+def bus_urls(port):
+    base = config.get("worker-bus-url", BUS_URL % port)
+    return base + "-in", base + "-out"
+
+def worker_index():
+    """Index of this worker process, None outside of worker mode."""
+    index = os.environ.get("GATEWAY_WORKER")
+    if index is None:
+        return None
+    return int(index)
+
+def status_port(port):
+    base = config.get("worker-status-port", port + STATUS_PORT_OFFSET)
+    return base + worker_index()
+
+def worker_bus(port):
+    count = int(os.environ["GATEWAY_WORKERS"])
+    publish_url, subscribe_url = bus_urls(port)
+    return Bus(worker_index(), count, publish_url, [subscribe_url])
+
+def run_master(count, port):
+    """Runs count gateway workers sharing the websocket port.
+
+    Workers are fresh interpreters running the same command line, so no
+    reactor or ZMQ state is shared by forking. They listen with
+    SO_REUSEPORT and talk over a local bus relayed by this process, which
+    also restarts any worker that dies. Each worker serves /status and
+    /metrics on its own status_port.
+    """
+    publish_url, subscribe_url = bus_urls(port)
+    context = zmq.Context()
+    frontend = context.socket(zmq.XSUB)
+    frontend.bind(publish_url)
+    backend = context.socket(zmq.XPUB)
+    backend.bind(subscribe_url)
+    relay = threading.Thread(target=zmq.proxy, args=(frontend, backend))
+    relay.daemon = True
+    relay.start()
+
+    processes = {}
+    def spawn(index):
+        env = dict(os.environ, GATEWAY_WORKER=str(index),
+                   GATEWAY_WORKERS=str(count))
+        processes[index] = subprocess.Popen([sys.executable] + sys.argv,
+                                            env=env)
+    def stop(signum, frame):
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in xrange(count):
+        spawn(index)
+    while True:
+        time.sleep(1)
+        for index, process in processes.items():
+            if process.poll() is not None:
+                logging.warning("Worker %d exited with %s, restarting",
+                                index, process.returncode)
+                spawn(index)
@@ -39,6 +39,8 @@ class PeerConnection(object):
         self.send_raw(json.dumps(data))
 
     def send_raw(self, serialized):
+        self._transport.messages_sent += 1
+        self._transport.bytes_sent += len(serialized)
         Process(target=self._send_raw, args=(serialized,)).start()
 
     def _send_raw(self, serialized):
@@ -72,6 +74,11 @@ class TransportLayer(object):
           net_ip = my_ip
         self._peers = {}
         self._callbacks = defaultdict(list)
+        # Traffic counters
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.messages_received = 0
+        self.bytes_received = 0
         self._id = my_ip[-1] # hack for logging
         self._port = port
         self._uri = 'tcp://%s:%s' % (my_ip, self._port)
@@ -90,6 +97,10 @@ class TransportLayer(object):
     def get_profile(self):
         return {'type': 'hello', 'uri': self._uri}
 
+    @property
+    def peer_count(self):
+        return len(self._peers)
+
     def join_network(self, seeds=[]):
         self.listen()
         for seed in seeds:
@@ -111,6 +122,8 @@ class TransportLayer(object):
             except:
                 message = None
             if message:
+                self.messages_received += 1
+                self.bytes_received += len(message)
                 self.on_raw_message(message)
                 self._socket.send(json.dumps({'type': "ok"}))
 